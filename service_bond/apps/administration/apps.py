@@ -2,4 +2,16 @@ from django.apps import AppConfig
 
 
 class AdministrationConfig(AppConfig):
-    name = 'administration'
+    name = 'apps.administration'
+    label = 'administration'
+
+    def ready(self):
+        from service_bond.helpers.memberships import connect_membership_signals
+        from service_bond.helpers.search import connect_search_signals
+        from service_bond.helpers.storage import connect_storage_signals
+        from service_bond.helpers.thumbnails import connect_thumbnail_signals
+
+        connect_membership_signals()
+        connect_search_signals()
+        connect_storage_signals()
+        connect_thumbnail_signals()
@@ -0,0 +1,30 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from service_bond.helpers.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild search indexes of models in SEARCH_INDEXES setting.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('labels', nargs='*', help='Models to reindex (i.e: administration.Customer), '
+                                                      'all indexed models by default.')
+        parser.add_argument('--database', default='default', help='Database to rebuild indexes of.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        labels = options['labels'] or list(getattr(settings, 'SEARCH_INDEXES', {}))
+        for label in labels:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+            backend = get_search_backend(model, options['database'])
+            if backend is None:
+                self.stdout.write(self.style.WARNING('{}: no search index on this database'.format(label)))
+                continue
+            backend.create_table(model)
+            count = backend.rebuild(model, batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS('{}: {} objects indexed'.format(label, count)))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from service_bond.helpers.index_advisor import ApiIndexAdvisor
+
+
+class Command(BaseCommand):
+    help = 'Report indexes needed by filter, ordering and search fields of the rest api views ' \
+           'and optionally write migrations creating the missing ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database to check indexes of.')
+        parser.add_argument('--write', action='store_true', help='Write migrations creating missing indexes.')
+        parser.add_argument('--name', default='api_indexes', help='Name of written migrations.')
+        parser.add_argument('--all', action='store_true', help='Also list indexes which already exist.')
+
+    def handle(self, *args, **options):
+        advisor = ApiIndexAdvisor(using=options['database'])
+        candidates = advisor.analyse()
+        missing = [c for c in candidates if not c.covered_by]
+
+        for candidate in candidates:
+            if candidate.covered_by and not options['all']:
+                continue
+            status = 'covered by {}'.format(candidate.covered_by) if candidate.covered_by else 'missing'
+            style = self.style.SUCCESS if candidate.covered_by else self.style.WARNING
+            self.stdout.write(style('{} ({}) {}: {}'.format(
+                candidate.table, ', '.join(candidate.columns), candidate.kind, status)))
+            for reason in candidate.reasons:
+                self.stdout.write('    {}'.format(reason))
+            if not candidate.covered_by:
+                self.stdout.write('    {}'.format(advisor.get_sql(candidate)[0]))
+
+        if options['write'] and missing:
+            for migration in advisor.build_migrations(name=options['name']).values():
+                path = advisor.write_migration(migration)
+                self.stdout.write(self.style.SUCCESS('Wrote {}'.format(path)))
+
+        for note in sorted(set(advisor.notes)):
+            self.stdout.write(self.style.NOTICE('note: {}'.format(note)))
+        self.stdout.write('{} indexes checked, {} missing.'.format(len(candidates), len(missing)))
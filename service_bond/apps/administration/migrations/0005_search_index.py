@@ -0,0 +1,48 @@
+from django.db import migrations
+
+# search index tables of the SEARCH_INDEXES setting when this migration was written. a model added to the setting
+# later needs its own migration, until then its table is created on its first save (see helpers/search.py)
+TABLES = ('administration_shop_search', 'administration_customer_search')
+
+CREATE_SQL = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(content, tenant UNINDEXED, "
+        "tokenize='unicode61 remove_diacritics 2')",
+    ],
+    'postgresql': [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE TABLE IF NOT EXISTS {table} (object_id bigint PRIMARY KEY, tenant bigint NULL, '
+        'content text NOT NULL, document tsvector NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS {document_index} ON {table} USING gin (document)',
+        'CREATE INDEX IF NOT EXISTS {content_index} ON {table} USING gin (content gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS {tenant_index} ON {table} (tenant)',
+    ],
+}
+
+
+def create_search_tables(apps, schema_editor):
+    quote = schema_editor.quote_name
+    for table in TABLES:
+        for sql in CREATE_SQL.get(schema_editor.connection.vendor, ()):
+            schema_editor.execute(sql.format(
+                table=quote(table), document_index=quote(table + '_document'),
+                content_index=quote(table + '_content_trgm'), tenant_index=quote(table + '_tenant')))
+
+
+def drop_search_tables(apps, schema_editor):
+    if schema_editor.connection.vendor not in CREATE_SQL:
+        return
+    for table in TABLES:
+        schema_editor.execute('DROP TABLE IF EXISTS {}'.format(schema_editor.quote_name(table)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('administration', '0004_customer_shop'),
+    ]
+
+    operations = [
+        # index tables are filled by 0007_fill_search_index
+        migrations.RunPython(create_search_tables, drop_search_tables),
+    ]
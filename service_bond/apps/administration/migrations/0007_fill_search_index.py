@@ -0,0 +1,51 @@
+from django.db import migrations
+
+# (index table, tenant column, indexed fields) of the SEARCH_INDEXES setting when this migration was written
+INDEXES = {
+    'Shop': ('administration_shop_search', 'id',
+             ['name', 'title', 'email', 'phone_number', 'street_address', 'city', 'state', 'zipcode']),
+    'Customer': ('administration_customer_search', 'shop_id',
+                 ['first_name', 'last_name', 'phone_number', 'street_address', 'city', 'state', 'zipcode']),
+}
+
+UPSERT_SQL = {
+    'sqlite': 'INSERT OR REPLACE INTO {table} (rowid, tenant, content) VALUES (%s, %s, %s)',
+    'postgresql': "INSERT INTO {table} (object_id, tenant, content, document) "
+                  "VALUES (%s, %s, %s, to_tsvector('simple', %s)) "
+                  "ON CONFLICT (object_id) DO UPDATE SET "
+                  "tenant = EXCLUDED.tenant, content = EXCLUDED.content, document = EXCLUDED.document",
+}
+
+BATCH_SIZE = 1000
+
+
+def fill_search_tables(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor not in UPSERT_SQL:
+        return
+    for model_name, (table, tenant, fields) in INDEXES.items():
+        model = apps.get_model('administration', model_name)
+        sql = UPSERT_SQL[connection.vendor].format(table=schema_editor.quote_name(table))
+        rows = model._base_manager.using(connection.alias).order_by().values_list('pk', tenant, *fields)
+        batch = []
+        with connection.cursor() as cursor:
+            for row in rows.iterator(chunk_size=BATCH_SIZE):
+                text = ' '.join(str(value) for value in row[2:] if value not in (None, ''))
+                batch.append([row[0], row[1], text] + ([text] if connection.vendor == 'postgresql' else []))
+                if len(batch) >= BATCH_SIZE:
+                    cursor.executemany(sql, batch)
+                    batch = []
+            if batch:
+                cursor.executemany(sql, batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('administration', '0006_storedfile'),
+    ]
+
+    operations = [
+        # objects saved before the index tables existed, the tables are kept up to date on save and delete since
+        migrations.RunPython(fill_search_tables, migrations.RunPython.noop),
+    ]
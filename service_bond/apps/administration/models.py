@@ -177,3 +177,13 @@ class Customer(TenantModel):
 #         return '{} - {}'.format(self.user, self.shop)
 
 
+
+class StoredFile(models.Model):
+    """ a file of the content addressed storage and the number of references to it """
+    name = models.CharField(max_length=255, primary_key=True)
+    size = models.BigIntegerField()
+    references = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{} ({})'.format(self.name, self.references)
@@ -18,7 +18,8 @@ from apps.administration.models import Shop
 from apps.administration.rest_api.filters import shopFilter
 from apps.administration.rest_api.serializers import SessionSerializer, UserSessionSerializer, UserProfileSerializer, \
     SetPasswordSerializer, shopSerializer
-from service_bond.helpers.utils import ExtendedOrderingFilterBackend, CustomLoggingMixin as LoggingMixin
+from service_bond.helpers.utils import ExtendedOrderingFilterBackend, CustomLoggingMixin as LoggingMixin, \
+    SparseFieldsetMixin, StreamingListMixin
 
 
 class HistoricalViewMixin(object):
@@ -167,7 +168,7 @@ class ProfileView(LoggingMixin, viewsets.ViewSet):
     create = put
 
 
-class shopView(LoggingMixin, viewsets.ReadOnlyModelViewSet):
+class shopView(LoggingMixin, SparseFieldsetMixin, StreamingListMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Shop.objects.all()
     permission_classes = (permissions.AllowAny,)
     serializer_class = shopSerializer
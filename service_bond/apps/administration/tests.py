@@ -1,3 +1,494 @@
-from django.test import TestCase
+import base64
+import datetime
+import io
+import os
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import get_resolver, get_script_prefix, resolve, reverse, set_script_prefix
+from django.views import View
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+import reversion
+from reversion.models import Version
+from django_multitenant.utils import unset_current_tenant
+from PIL import Image
+
+from apps.administration.models import Customer, Shop, StoredFile, User
+from service_bond.helpers.memberships import MembershipCache, connect_membership_signals, membership_cache
+from service_bond.helpers.middleware import CustomRevisionMiddleware, SubpathURLRoutingMiddleware
+from service_bond.helpers.permissions import USER_VERSION_KEY, PermissionCache, set_version
+from service_bond.helpers.revisions import RevisionCapture, write_revisions
+from service_bond.helpers import utils
+from service_bond.helpers.utils import Base64ImageField, CustomPagination, InternalViewMixin, to_dict, to_dict_many
+
+SHARED_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': tempfile.mkdtemp(prefix='permission-cache-'),
+    }
+}
+
+
+class PermissionCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.perms = {'bike.view_bike', 'bike.change_bike'}
+        self.loads = 0
+        self.cache = PermissionCache({'bike.view_bike', 'bike.change_bike'})
+
+    def loader(self):
+        self.loads += 1
+        return set(self.perms), set()
+
+    def get_perms(self):
+        return self.cache.get(1, 1, self.loader)[0]
+
+    @override_settings(CACHES=SHARED_CACHES)
+    def test_revoked_permission_is_not_granted_after_version_eviction(self):
+        caches['default'].clear()
+        self.assertIn('bike.change_bike', self.get_perms())
+        self.perms.discard('bike.change_bike')
+        set_version(USER_VERSION_KEY.format(1))
+        self.assertNotIn('bike.change_bike', self.get_perms())
+        # the version is evicted, the entry of the first version must not be served again
+        caches['default'].delete(USER_VERSION_KEY.format(1))
+        self.assertNotIn('bike.change_bike', self.get_perms())
+
+    @override_settings(CACHES=SHARED_CACHES)
+    def test_permissions_are_cached(self):
+        caches['default'].clear()
+        self.get_perms()
+        self.get_perms()
+        self.assertEqual(self.loads, 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_local_memory_cache_is_not_used(self):
+        self.assertIn('bike.change_bike', self.get_perms())
+        self.perms.discard('bike.change_bike')
+        self.assertNotIn('bike.change_bike', self.get_perms())
+        self.assertEqual(self.loads, 2)
+
+
+class KeysetPaginationTests(TestCase):
+
+    def test_microsecond_spaced_datetimes_are_walked_to_the_end(self):
+        start = timezone.now().replace(microsecond=0)
+        users = [User.objects.create(username='user{}'.format(i),
+                                     date_joined=start + datetime.timedelta(microseconds=i)) for i in range(10)]
+        queryset = User.objects.filter(pk__in=[user.pk for user in users]).order_by('date_joined')
+        factory = APIRequestFactory()
+        seen, cursor = [], None
+        for _ in range(len(users)):
+            params = {'pagination': 'keyset', 'page_size': 3}
+            if cursor:
+                params['cursor'] = cursor
+            paginator = CustomPagination()
+            seen += [user.pk for user in paginator.paginate_queryset(queryset, Request(factory.get('/', params)))]
+            cursor = paginator.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(seen, [user.pk for user in users])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix='content-addressed-'), THUMBNAIL_FIELDS={})
+class ContentAddressedStorageTests(TransactionTestCase):
+
+    def save(self, content, name='logo.png'):
+        return default_storage.save(name, ContentFile(content))
+
+    def references(self, name):
+        return StoredFile.objects.get(name=name).references
+
+    def test_same_content_is_stored_once(self):
+        first, second = self.save(b'logo'), self.save(b'logo', name='other.png')
+        self.assertEqual(first, second)
+        self.assertEqual(self.references(first), 2)
+        self.assertEqual(len(os.listdir(os.path.dirname(default_storage.path(first)))), 1)
+        self.assertNotEqual(self.save(b'another logo'), first)
+
+    def test_file_is_deleted_with_its_last_reference(self):
+        name = self.save(b'logo')
+        self.save(b'logo')
+        default_storage.delete(name)
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(self.references(name), 1)
+        default_storage.delete(name)
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(StoredFile.objects.filter(name=name).exists())
+
+    def test_rolled_back_delete_keeps_the_file(self):
+        name = self.save(b'logo')
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                default_storage.delete(name)
+                raise ValueError()
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(self.references(name), 1)
+
+    def test_save_after_last_reference_is_released_keeps_the_file(self):
+        name = self.save(b'logo')
+        with transaction.atomic():
+            default_storage.delete(name)
+            self.assertEqual(self.save(b'logo'), name)
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(self.references(name), 1)
+
+    def test_replaced_and_deleted_files_are_released(self):
+        user = User.objects.create(username='avatar')
+        user.avatar = ContentFile(b'first', name='first.png')
+        user.save()
+        first = user.avatar.name
+        user = User.objects.get(pk=user.pk)
+        user.avatar = ContentFile(b'second', name='second.png')
+        user.save()
+        second = user.avatar.name
+        self.assertFalse(default_storage.exists(first))
+        # the same content uploaded again replaces its own reference
+        user.avatar = ContentFile(b'second', name='second.png')
+        user.save()
+        self.assertEqual(self.references(second), 1)
+        User.objects.get(pk=user.pk).delete()
+        self.assertFalse(default_storage.exists(second))
+
+
+class RevisionCaptureTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(RevisionCaptureTests, cls).setUpClass()
+        reversion.register(Shop)
+        reversion.register(Customer, follow=('shop',))
+
+    @classmethod
+    def tearDownClass(cls):
+        reversion.unregister(Customer)
+        reversion.unregister(Shop)
+        super(RevisionCaptureTests, cls).tearDownClass()
+
+    def test_objects_are_written_as_they_were_saved(self):
+        with RevisionCapture() as capture:
+            shop = Shop.objects.create(name='bikes', title='Bikes')
+            shop.title = 'Bikes and more'
+            shop.save()
+        shop.title = 'not saved'
+        write_revisions([capture])
+        version = Version.objects.get_for_object(shop).get()
+        self.assertEqual(version.field_dict['title'], 'Bikes and more')
+
+    def test_followed_objects_are_written(self):
+        shop = Shop.objects.create(name='bikes', title='Bikes')
+        user = User.objects.create(username='editor')
+        with RevisionCapture() as capture:
+            customer = Customer.objects.create(shop=shop, first_name='Ana', last_name='Silva')
+        capture.user = user
+        write_revisions([capture])
+        version = Version.objects.get_for_object(customer).get()
+        self.assertEqual(version.revision.user, user)
+        self.assertEqual(version.revision.date_created, capture.date_created)
+        self.assertEqual(Version.objects.get_for_object(shop).get().revision, version.revision)
+
+    @override_settings(REVISION_CAPTURE_MODE=CustomRevisionMiddleware.CAPTURE_AFTER_RESPONSE)
+    def test_revision_is_written_when_the_response_is_closed(self):
+        def view(request):
+            Shop.objects.create(name='bikes', title='Bikes')
+            return HttpResponse()
+
+        response = CustomRevisionMiddleware(view)(RequestFactory().post('/'))
+        self.assertFalse(Version.objects.exists())
+        response.close()
+        self.assertEqual(Version.objects.get().field_dict['title'], 'Bikes')
+
+
+class InternalView(InternalViewMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse('internal')
+
+
+@override_settings(INTERNAL_API_TOKEN='secret')
+class InternalViewTests(SimpleTestCase):
+
+    def get(self, user=None, **headers):
+        request = RequestFactory().get('/internal/metrics', REMOTE_ADDR='127.0.0.1', **headers)
+        request.user = user or AnonymousUser()
+        return InternalView.as_view()(request).status_code
+
+    def test_loopback_address_is_not_trusted(self):
+        self.assertEqual(self.get(), 403)
+
+    def test_staff_users_are_allowed(self):
+        self.assertEqual(self.get(User(username='staff', is_staff=True)), 200)
+        self.assertEqual(self.get(User(username='user')), 403)
+
+    def test_token(self):
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer secret'), 200)
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer wrong'), 403)
+        with self.settings(INTERNAL_API_TOKEN=None):
+            self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer '), 403)
+
+
+class ShopMember(models.Model):
+    """ membership model of MembershipCacheTests, the tree has no membership model yet """
+    # deletes of users and shops in other tests must not look for memberships, the table exists in these tests only
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    shop = models.ForeignKey(Shop, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+
+    class Meta:
+        app_label = 'administration'
+        managed = False
+
+
+@override_settings(CACHES=SHARED_CACHES, SHOP_MEMBERSHIP_MODEL='administration.ShopMember')
+class MembershipCacheTests(TransactionTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(MembershipCacheTests, cls).setUpClass()
+        with connection.schema_editor() as editor:
+            editor.create_model(ShopMember)
+        connect_membership_signals()
+
+    @classmethod
+    def tearDownClass(cls):
+        for signal, dispatch_uid in ((post_init, 'membership_cache_post_init'),
+                                     (post_save, 'membership_cache_post_save'),
+                                     (post_delete, 'membership_cache_post_delete')):
+            signal.disconnect(sender=ShopMember, dispatch_uid=dispatch_uid)
+        user_logged_in.disconnect(dispatch_uid='membership_cache_warm')
+        with connection.schema_editor() as editor:
+            editor.delete_model(ShopMember)
+        super(MembershipCacheTests, cls).tearDownClass()
+
+    def setUp(self):
+        caches['default'].clear()
+        membership_cache.clear()
+        self.user = User.objects.create(username='member')
+        self.shop = Shop.objects.create(name='bikes', title='Bikes')
+        self.other_shop = Shop.objects.create(name='boats', title='Boats')
+
+    def tearDown(self):
+        # tables of unmanaged models are not flushed
+        ShopMember.objects.all().delete()
+
+    def test_answers_are_cached(self):
+        ShopMember.objects.create(user=self.user, shop=self.shop)
+        with self.assertNumQueries(2):
+            for _ in range(2):
+                self.assertTrue(membership_cache.is_member(self.user.pk, self.shop.pk))
+                self.assertFalse(membership_cache.is_member(self.user.pk, self.other_shop.pk))
+
+    def test_other_processes_use_the_shared_cache(self):
+        ShopMember.objects.create(user=self.user, shop=self.shop)
+        membership_cache.is_member(self.user.pk, self.shop.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(MembershipCache().is_member(self.user.pk, self.shop.pk))
+
+    def test_warmed_user_is_answered_without_queries(self):
+        ShopMember.objects.create(user=self.user, shop=self.shop)
+        user_logged_in.send(sender=User, request=None, user=self.user)
+        with self.assertNumQueries(0):
+            self.assertTrue(membership_cache.is_member(self.user.pk, self.shop.pk))
+            self.assertFalse(MembershipCache().is_member(self.user.pk, self.other_shop.pk))
+
+    def test_membership_changes_invalidate_answers(self):
+        self.assertFalse(membership_cache.is_member(self.user.pk, self.shop.pk))
+        member = ShopMember.objects.create(user=self.user, shop=self.shop)
+        self.assertTrue(membership_cache.is_member(self.user.pk, self.shop.pk))
+        member = ShopMember.objects.get(pk=member.pk)
+        member.shop = self.other_shop
+        member.save()
+        self.assertFalse(membership_cache.is_member(self.user.pk, self.shop.pk))
+        self.assertTrue(membership_cache.is_member(self.user.pk, self.other_shop.pk))
+        member.delete()
+        self.assertFalse(membership_cache.is_member(self.user.pk, self.other_shop.pk))
+
+    def test_local_entries_expire(self):
+        cache = MembershipCache(local_ttl=0.01)
+        self.assertFalse(cache.is_member(self.user.pk, self.shop.pk))
+        # a change made by another process clears the shared entries only
+        caches['default'].clear()
+        ShopMember.objects.create(user=self.user, shop=self.shop)
+        time.sleep(0.02)
+        self.assertTrue(cache.is_member(self.user.pk, self.shop.pk))
+
+
+class ToDictTests(TestCase):
+
+    def setUp(self):
+        self.shop = Shop.objects.create(name='bikes', title='Bikes')
+        self.customer = Customer.objects.create(shop=self.shop, first_name='Ana', last_name='Silva')
+
+    def test_foreign_keys_of_values_rows(self):
+        row, = to_dict_many(Customer.objects.filter(pk=self.customer.pk).values())
+        self.assertEqual(row['shop_id'], self.shop.pk)
+        self.assertEqual(row['first_name'], 'Ana')
+
+    def test_inline_functions_share_one_plan(self):
+        utils._to_dict_plans.clear()
+        for suffix in ('a', 'b', 'c'):
+            data = to_dict(self.customer, fields=['first_name'], fields_map={'title': lambda: suffix},
+                           extra_fields=['title'])
+            self.assertEqual(data, {'first_name': 'Ana', 'title': suffix})
+        self.assertEqual(len(utils._to_dict_plans), 1)
+
+
+class ShopURLRoutingTests(TestCase):
+
+    def setUp(self):
+        self.shops = [Shop.objects.create(name='bikes', title='Bikes'), Shop.objects.create(name='boats', title='Boats')]
+        self.middleware = SubpathURLRoutingMiddleware(lambda request: HttpResponse())
+
+    def tearDown(self):
+        set_script_prefix('/')
+        unset_current_tenant()
+
+    def route(self, path):
+        request = RequestFactory().get(path)
+        self.middleware.set_subpath(request)
+        return request
+
+    def test_shops_share_one_urlconf(self):
+        urlconfs = set()
+        for shop in self.shops:
+            request = self.route('/shop/{}/admin/'.format(shop.pk))
+            self.assertEqual(request.shop, shop)
+            match = resolve(request.path_info, urlconf=request.urlconf)
+            self.assertEqual(match.view_name, 'shop_admin:index')
+            self.assertEqual(match.kwargs, {})
+            # urls are reversed under the prefix of the current shop
+            self.assertEqual(reverse('shop_admin:index', urlconf=request.urlconf), '/shop/{}/admin/'.format(shop.pk))
+            self.assertEqual(reverse('shop:index', urlconf=request.urlconf), '/shop/{}/'.format(shop.pk))
+            self.middleware.process_response(request, HttpResponse())
+            self.assertEqual(get_script_prefix(), '/')
+            urlconfs.add(request.urlconf)
+        self.assertEqual(urlconfs, {'service_bond.urls_shop'})
+        self.assertEqual(len(get_resolver('service_bond.urls_shop').url_patterns), 1)
+
+    def test_unknown_shop(self):
+        request = self.route('/shop/0/admin/')
+        self.assertIsNone(request.shop)
+        self.assertIsNone(request.urlconf)
+        self.assertEqual(get_script_prefix(), '/')
+
+
+class LoggedView(utils.CustomLoggingMixin):
+    sensitive_fields = {'PIN'}
+
+
+class CleanDataTests(SimpleTestCase):
+
+    def setUp(self):
+        self.view = LoggedView()
+
+    def test_sensitive_keys_at_depth(self):
+        data = {'shop': {'owners': [{'Password': 'p', 'pin': '1234', 'name': 'Ana'}], 'KEY': 'k'},
+                'image': 'data'}
+        self.assertEqual(self.view._clean_data(data), {
+            'shop': {'owners': [{'Password': '****', 'pin': '****', 'name': 'Ana'}], 'KEY': '****'},
+            'image': '<<skipped>>',
+        })
+
+    def test_sensitive_keys_in_serialized_values(self):
+        data = {'payload': '{"token": "t", "items": [{"secret": "s", "id": 1}]}', 'note': '[not a list'}
+        self.assertEqual(self.view._clean_data(data), {
+            'payload': {'token': '****', 'items': [{'secret': '****', 'id': 1}]},
+            'note': '[not a list',
+        })
+
+    def test_long_serialized_values_are_dropped(self):
+        self.view.logging_max_string_length = 32
+        payload = '{{"password": "p", "padding": "{}"}}'.format('x' * 32)
+        self.assertEqual(self.view._clean_data({'payload': payload, 'text': 'y' * 40}),
+                         {'payload': '<<truncated>>', 'text': 'y' * 32 + '<<truncated>>'})
+
+    def test_values_past_the_item_cap(self):
+        self.view.logging_max_items = 2
+        data = {'a': 1, 'b': 2, 'password': 'p', 'nested': {'token': 't'}}
+        self.assertEqual(self.view._clean_data(data),
+                         {'a': 1, 'b': 2, 'password': '<<truncated>>', 'nested': '<<truncated>>'})
+        self.assertEqual(self.view._clean_data([1, 2, {'password': 'p'}, 4]), [1, 2, '<<truncated>>'])
+
+    def test_containers_past_the_depth_cap(self):
+        self.view.logging_max_depth = 2
+        data = {'a': {'password': 'p', 'b': {'password': 'p'}}, 'c': '{"d": {"secret": "s"}}'}
+        self.assertEqual(self.view._clean_data(data),
+                         {'a': {'password': '****', 'b': '<<truncated>>'}, 'c': {'d': '<<truncated>>'}})
+
+
+def make_png(size=(8, 8)):
+    output = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(output, 'PNG')
+    return output.getvalue()
+
+
+class ImageSerializer(serializers.Serializer):
+    image = Base64ImageField()
+
+
+class Base64ImageFieldTests(SimpleTestCase):
+
+    def setUp(self):
+        self.png = make_png()
+        self.field = Base64ImageField()
+
+    def data_url(self, content, content_type='image/png'):
+        return 'data:{};base64,{}'.format(content_type, base64.b64encode(content).decode())
+
+    def assertFails(self, code, data):
+        serializer = ImageSerializer(data={'image': data})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors['image'][0].code, code)
+
+    def test_decodes_data_url(self):
+        image = self.field.to_internal_value(self.data_url(self.png, 'image/gif'))
+        self.assertIsInstance(image, InMemoryUploadedFile)
+        # the type is taken from the content, not from the data url
+        self.assertTrue(image.name.endswith('.png'))
+        self.assertEqual(image.content_type, 'image/png')
+        self.assertEqual(image.read(), self.png)
+
+    def test_oversize_payload_is_not_decoded(self):
+        with override_settings(BASE64_IMAGE_MAX_SIZE=len(self.png) // 2), \
+                mock.patch.object(utils.base64, 'b64decode', side_effect=AssertionError('decoded')):
+            self.assertFails('image_too_large', self.data_url(self.png))
+
+    def test_whitespace_between_chunks(self):
+        encoded = base64.b64encode(self.png).decode()
+        wrapped = '\n'.join(encoded[i:i + 7] for i in range(0, len(encoded), 7))
+        self.field.CHUNK_SIZE = 16
+        image = self.field.to_internal_value('data:image/png;base64,' + wrapped)
+        self.assertEqual(image.read(), self.png)
+        image = self.field.to_internal_value(io.BytesIO(('data:image/png;base64,' + wrapped).encode()))
+        self.assertEqual(image.read(), self.png)
+
+    def test_big_image_is_decoded_to_a_temporary_file(self):
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=len(self.png) - 1):
+            image = self.field.to_internal_value(self.data_url(self.png))
+        try:
+            self.assertIsInstance(image, TemporaryUploadedFile)
+            self.assertEqual(image.size, len(self.png))
+            self.assertEqual(image.read(), self.png)
+        finally:
+            image.close()
+        # the decoded size is estimated from the base64 length, padding included
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=len(self.png) + 2):
+            self.assertIsInstance(self.field.to_internal_value(self.data_url(self.png)), InMemoryUploadedFile)
+
+    def test_non_image_payload(self):
+        self.assertFails('invalid_image', self.data_url(b'<svg xmlns="http://www.w3.org/2000/svg"></svg>'))
+        self.assertFails('invalid_image', self.data_url(self.png[:16] + b'\0' * 64))
+        self.assertFails('invalid_image', 'data:image/png;base64,not*base64')
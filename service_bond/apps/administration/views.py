@@ -1,9 +1,15 @@
 from django.contrib.auth import logout as auth_logout
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.views import View
 from django.views.generic import TemplateView
 
+from service_bond.helpers.errors import error_report
+from service_bond.helpers.metrics import request_metrics
+from service_bond.helpers.profiling import query_report
+from service_bond.helpers.utils import InternalViewMixin
+
 
 class IndexView(View):
 
@@ -38,3 +44,22 @@ class PrivacyPolicyView(TemplateView):
 
 class TermsOfServiceView(TemplateView):
     template_name = 'bike/terms_of_service.html'
+
+
+class QueryReportView(InternalViewMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(query_report.as_dict())
+
+
+class MetricsView(InternalViewMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class ErrorReportView(InternalViewMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        limit = request.GET.get('limit')
+        return JsonResponse(error_report.as_dict(int(limit) if limit and limit.isdigit() else 50))
@@ -11,17 +11,17 @@ from apps.administration.models import Customer
 from apps.shop.rest_api.filters import CustomerFilter
 from apps.shop.rest_api.serializers import CustomerSerializer
 from service_bond.helpers.utils import CustomLoggingMixin as LoggingMixin, IsOwnerPermission, shopCustomerPermission, \
-    CreateListMixin
+    CreateListMixin, SparseFieldsetMixin
 
 
-class CustomerView(LoggingMixin, viewsets.ReadOnlyModelViewSet):
+class CustomerView(LoggingMixin, SparseFieldsetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Customer.objects.all()
     permission_classes = (permissions.AllowAny,)
     serializer_class = CustomerSerializer
     filterset_class = CustomerFilter
     ordering = 'id'
     ordering_fields = '__all__'
-    search_fields = '__all__'
+    search_fields = ['first_name', 'last_name', 'phone_number', 'street_address', 'city', 'state', 'zipcode']
 
     def get_queryset(self):
         # Notice!!! dont call super().get_queryset().
@@ -0,0 +1,112 @@
+import atexit
+import functools
+import os
+import queue
+import threading
+import time
+import traceback
+
+from django.db import close_old_connections
+
+print = functools.partial(print, flush=True)
+
+
+class BatchWriter(object):
+    """
+    Collects items in a bounded in-process queue and passes them in batches to ``flush_func``
+    from a background thread. a batch is flushed when it has ``batch_size`` items or when
+    ``flush_interval`` seconds passed since its first item. pending items are flushed at process exit.
+
+    ``put`` blocks while the queue is full. if ``put_timeout`` is set, it waits at most that many seconds
+    and then drops the item, dropped items are counted in ``dropped``.
+    """
+    _STOP = object()
+
+    def __init__(self, name, flush_func, batch_size=100, flush_interval=1.0, max_queue_size=10000,
+                 put_timeout=None):
+        self.name = name
+        self.flush_func = flush_func
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            if self._pid is None:
+                atexit.register(self.stop)
+            # threads don't survive a fork, a forked worker starts its own thread with a new queue
+            if self._pid is not None:
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            self._pid = pid
+
+    def put(self, item):
+        """ queue an item, return False if it's dropped because the queue is full """
+        self._ensure_started()
+        try:
+            self._queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped == 1 or dropped % 1000 == 0:
+                print('{}: queue is full, {} items dropped so far'.format(self.name, dropped))
+            return False
+        return True
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _flush(self, batch):
+        try:
+            close_old_connections()
+            self.flush_func(batch)
+        except Exception:
+            traceback.print_exc()
+            print('{}: failed to flush {} items'.format(self.name, len(batch)))
+
+    def _run(self):
+        while True:
+            batch = []
+            item = self._queue.get()
+            stop = item is self._STOP
+            if not stop:
+                batch.append(item)
+            deadline = time.monotonic() + self.flush_interval
+            while not stop and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                else:
+                    batch.append(item)
+            if batch:
+                self._flush(batch)
+            if stop:
+                return
+
+    def stop(self, timeout=10):
+        """ flush pending items and stop the background thread """
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
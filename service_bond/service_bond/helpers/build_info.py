@@ -0,0 +1,122 @@
+import functools
+import hashlib
+import os
+import threading
+import time
+import traceback
+
+import simplejson as json
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+print = functools.partial(print, flush=True)
+
+
+class WatchedFile(object):
+    """
+    Content of a file loaded by ``loader`` and reloaded only when the file mtime changes.
+    mtime is checked at most once every ``check_interval`` seconds.
+    """
+
+    def __init__(self, path, loader, check_interval=5):
+        self.path = path
+        self.loader = loader
+        self.check_interval = check_interval
+        self._value = None
+        self._mtime = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime and self._checked_at is not None:
+            return
+        value = None
+        if mtime is None:
+            print('Cannot find {}'.format(self.path))
+        else:
+            try:
+                value = self.loader(self.path)
+            except Exception:
+                traceback.print_exc()
+        self._mtime = mtime
+        self._value = value
+
+    def get(self):
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.check_interval:
+            with self._lock:
+                if self._checked_at is None or now - self._checked_at >= self.check_interval:
+                    self._reload()
+                    self._checked_at = now
+        return self._value
+
+
+def _load_package_version(path):
+    with open(path) as f:
+        return json.load(f).get('version')
+
+
+def _load_file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+class BuildMetadata(object):
+    """
+    Version information of the running build: ui version (from package.json of the ui),
+    hash of the static files manifest and the build id (``BUILD_ID`` setting or environment variable).
+    values are kept in memory and files are re-read only when they change.
+    """
+
+    def __init__(self):
+        check_interval = getattr(settings, 'BUILD_METADATA_CHECK_INTERVAL', 5)
+        self._ui_package = WatchedFile(
+            os.path.join(settings.BASE_DIR, 'FRONTEND', 'service_bond_ui', 'package.json'),
+            _load_package_version, check_interval)
+        manifest_path = self._get_static_manifest_path()
+        self._static_manifest = WatchedFile(manifest_path, _load_file_hash, check_interval) if manifest_path else None
+        self.build_id = getattr(settings, 'BUILD_ID', None) or os.environ.get('BUILD_ID')
+
+    @staticmethod
+    def _get_static_manifest_path():
+        # only manifest based storages (i.e. IgnorableManifestFilesMixin) on local file system have a manifest file
+        manifest_name = getattr(staticfiles_storage, 'manifest_name', None)
+        if not manifest_name:
+            return None
+        try:
+            return staticfiles_storage.path(manifest_name)
+        except NotImplementedError:
+            return None
+
+    @property
+    def ui_version(self):
+        return self._ui_package.get()
+
+    @property
+    def static_manifest_hash(self):
+        return self._static_manifest.get() if self._static_manifest else None
+
+    def as_dict(self):
+        return {
+            'ui_version': self.ui_version,
+            'static_manifest_hash': self.static_manifest_hash,
+            'build_id': self.build_id,
+        }
+
+    def headers(self):
+        values = (
+            ('X-UI-Version', self.ui_version),
+            ('X-Static-Manifest-Hash', self.static_manifest_hash),
+            ('X-Build-Id', self.build_id),
+        )
+        return [(k, v) for k, v in values if v]
+
+
+build_metadata = BuildMetadata()
@@ -0,0 +1,85 @@
+import functools
+import hashlib
+import sys
+import threading
+import time
+import traceback
+
+from django.conf import settings
+
+print = functools.partial(print, flush=True)
+
+
+def get_exception_frames(exc, depth):
+    """ (file, function, line) of the ``depth`` innermost frames of an exception, without reading sources """
+    frames = [(frame.f_code.co_filename, frame.f_code.co_name, lineno)
+              for frame, lineno in traceback.walk_tb(exc.__traceback__)]
+    return frames[-depth:]
+
+
+def fingerprint_exception(exc, depth):
+    """ return (fingerprint, exception type, frames), exceptions raised at the same place have one fingerprint """
+    exc_type = '{}.{}'.format(type(exc).__module__, type(exc).__qualname__)
+    frames = get_exception_frames(exc, depth)
+    key = '|'.join([exc_type] + ['{}:{}:{}'.format(*frame) for frame in frames])
+    return hashlib.md5(key.encode()).hexdigest()[:12], exc_type, frames
+
+
+class ErrorReport(object):
+    """
+    Counts of unexpected errors per fingerprint (exception type and innermost frames).
+
+    the traceback of an error is printed for the first ``ERROR_REPORT_FIRST_N`` errors of a fingerprint and then
+    for every ``ERROR_REPORT_SAMPLE_EVERY``-th one, so a storm of one error doesn't flood the output. at most
+    ``ERROR_REPORT_SIZE`` fingerprints are kept, the least recently seen is dropped first.
+    """
+
+    def __init__(self, size=None, first_n=None, sample_every=None, depth=None):
+        self.size = size or getattr(settings, 'ERROR_REPORT_SIZE', 200)
+        self.first_n = first_n if first_n is not None else getattr(settings, 'ERROR_REPORT_FIRST_N', 5)
+        self.sample_every = sample_every or getattr(settings, 'ERROR_REPORT_SAMPLE_EVERY', 100)
+        self.depth = depth or getattr(settings, 'ERROR_REPORT_FRAMES', 3)
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, exc):
+        """ count an error, return (fingerprint, its count, whether its traceback should be printed) """
+        fingerprint, exc_type, frames = fingerprint_exception(exc, self.depth)
+        now = time.time()
+        with self._lock:
+            error = self._errors.get(fingerprint)
+            if error is None:
+                if len(self._errors) >= self.size:
+                    oldest = min(self._errors.values(), key=lambda e: e['last_seen'])
+                    del self._errors[oldest['fingerprint']]
+                error = self._errors[fingerprint] = {
+                    'fingerprint': fingerprint, 'type': exc_type, 'message': str(exc)[:200],
+                    'frames': ['{}:{} in {}'.format(filename, lineno, name) for filename, name, lineno in frames],
+                    'count': 0, 'printed': 0, 'first_seen': now,
+                }
+            error['count'] += 1
+            error['last_seen'] = now
+            count = error['count']
+            emit = count <= self.first_n or count % self.sample_every == 0
+            if emit:
+                error['printed'] += 1
+        return fingerprint, count, emit
+
+    def report(self, exc):
+        """ count an error and print its traceback if it's not sampled out """
+        fingerprint, count, emit = self.add(exc)
+        if emit:
+            print('error {} seen {} times'.format(fingerprint, count), file=sys.stderr)
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+    def as_dict(self, limit=None):
+        with self._lock:
+            errors = sorted(self._errors.values(), key=lambda e: (e['count'], e['last_seen']), reverse=True)
+            return {'errors': [dict(e) for e in errors[:limit]]}
+
+    def clear(self):
+        with self._lock:
+            self._errors.clear()
+
+
+error_report = ErrorReport()
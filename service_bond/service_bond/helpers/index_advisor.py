@@ -0,0 +1,350 @@
+import os
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, migrations
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+from django.urls import URLPattern, URLResolver, get_resolver
+from django_filters import OrderingFilter as FilterSetOrderingFilter
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework.filters import OrderingFilter, SearchFilter
+
+from service_bond.helpers.search import FullTextSearchFilter, get_search_backend
+
+# internal types of fields which btree indexes don't help with (or can't be created on)
+UNINDEXABLE_TYPES = {'TextField', 'BinaryField', 'JSONField'}
+# filter lookups which can use a btree index
+BTREE_LOOKUPS = {'exact', 'in', 'gt', 'gte', 'lt', 'lte', 'range', 'isnull', 'startswith', 'date', 'year'}
+# filter/search lookups which need a trigram index (postgres only)
+TRIGRAM_LOOKUPS = {'icontains', 'contains', 'iexact', 'istartswith', 'iendswith', 'endswith'}
+SEARCH_LOOKUPS = {'^': 'istartswith', '=': 'iexact', '@': 'search', '$': 'iregex'}
+
+
+class IndexCandidate(object):
+    """ an index which would serve some api lookups, ``kind`` is 'btree' or 'trigram' """
+
+    def __init__(self, model, columns, kind='btree', pk_suffix=False):
+        self.model = model
+        self.columns = tuple(columns)
+        self.kind = kind
+        self.pk_suffix = pk_suffix
+        self.reasons = []
+        self.covered_by = None
+        self.name = None
+
+    @property
+    def table(self):
+        return self.model._meta.db_table
+
+    @property
+    def key(self):
+        return self.table, self.columns, self.kind
+
+    @property
+    def required_prefix(self):
+        """ columns an existing index must start with to serve the same lookups """
+        return self.columns[:-1] if self.pk_suffix else self.columns
+
+
+class ApiIndexAdvisor(object):
+    """
+    Find indexes needed by filter, ordering and search declarations of the rest api views
+    and check them against the indexes of the database.
+
+    only list routes of the root and subpath urlconfs are analysed. search fields of a model which has a search
+    index (FullTextSearchFilter) don't need indexes. lookups are mapped to columns of the view model, lookups through
+    relations are reported as notes. on tenant models indexes start with the tenant column since
+    every query is scoped to a shop, ordering indexes end with the pk to keep keyset pagination and
+    ordering ties on the index.
+    """
+
+    def __init__(self, using='default', urlconf=None):
+        self.using = using
+        self.connection = connections[using]
+        self.urlconf = urlconf
+        self.candidates = OrderedDict()
+        self.notes = []
+
+    # view discovery
+
+    def get_urlconfs(self):
+        """ the root urlconf and the urlconfs of subpaths (``SUBPATH_URLCONFS``), they aren't included by the root """
+        if self.urlconf is not None:
+            return [self.urlconf]
+        urlconfs = [settings.ROOT_URLCONF]
+        for urlconf in getattr(settings, 'SUBPATH_URLCONFS', {}).values():
+            if urlconf not in urlconfs:
+                urlconfs.append(urlconf)
+        return urlconfs
+
+    def iter_list_views(self, patterns=None, prefix=''):
+        """ yield (route, view class, initkwargs) of list routes """
+        if patterns is None:
+            for urlconf in self.get_urlconfs():
+                yield from self.iter_list_views(get_resolver(urlconf).url_patterns, prefix)
+            return
+        for pattern in patterns:
+            route = prefix + str(pattern.pattern)
+            if isinstance(pattern, URLResolver):
+                yield from self.iter_list_views(pattern.url_patterns, route)
+                continue
+            if not isinstance(pattern, URLPattern):
+                continue
+            view_cls = getattr(pattern.callback, 'cls', None)
+            if view_cls is None or not hasattr(view_cls, 'filter_backends'):
+                continue
+            actions = getattr(pattern.callback, 'actions', None)
+            if actions is not None and actions.get('get') != 'list':
+                continue
+            yield route, view_cls, getattr(pattern.callback, 'initkwargs', {}) or {}
+
+    @staticmethod
+    def _get_model(view_cls, attrs):
+        queryset = attrs.get('queryset', getattr(view_cls, 'queryset', None))
+        if queryset is not None:
+            return queryset.model
+        serializer_class = attrs.get('serializer_class', getattr(view_cls, 'serializer_class', None))
+        meta = getattr(serializer_class, 'Meta', None)
+        return getattr(meta, 'model', None)
+
+    # lookups -> columns
+
+    def _get_tenant_columns(self, model):
+        tenant_id = getattr(model, 'tenant_id', None)
+        if not tenant_id:
+            return ()
+        for field in model._meta.concrete_fields:
+            if tenant_id in (field.name, field.attname) and not field.primary_key:
+                return (field.column,)
+        return ()
+
+    def _resolve_field(self, model, lookup, view_name):
+        """ return the local field of ``lookup`` or None if it can't be indexed on the model table """
+        parts = lookup.split('__')
+        try:
+            field = model._meta.get_field(parts[0])
+        except FieldDoesNotExist:
+            self.notes.append('{}: unknown field "{}" on {}'.format(view_name, lookup, model._meta.label))
+            return None
+        if field.is_relation and len(parts) > 1 and parts[1] not in ('id', 'pk', 'in', 'exact', 'isnull'):
+            self.notes.append('{}: "{}" goes through a relation, index it on {}'.format(
+                view_name, lookup, field.related_model._meta.label if field.related_model else 'the related model'))
+            return None
+        if not field.concrete or field.many_to_many:
+            return None
+        if field.get_internal_type() in UNINDEXABLE_TYPES:
+            self.notes.append('{}: "{}" is a {}, it is not indexed'.format(
+                view_name, lookup, field.get_internal_type()))
+            return None
+        return field
+
+    def _add(self, model, columns, kind, reason, pk_suffix=False):
+        columns = tuple(OrderedDict.fromkeys(columns))
+        candidate = IndexCandidate(model, columns, kind=kind, pk_suffix=pk_suffix)
+        candidate = self.candidates.setdefault(candidate.key, candidate)
+        if reason not in candidate.reasons:
+            candidate.reasons.append(reason)
+
+    def add_ordering(self, model, lookup, view_name):
+        lookup = lookup.lstrip('-')
+        field = self._resolve_field(model, lookup, view_name)
+        if field is None:
+            return
+        pk_column = model._meta.pk.column
+        columns = self._get_tenant_columns(model) + (field.column,)
+        if field.column != pk_column:
+            columns += (pk_column,)
+        self._add(model, columns, 'btree', '{} order_by={}'.format(view_name, lookup), pk_suffix=True)
+
+    def add_filter(self, model, lookup, lookup_expr, view_name, source='filter'):
+        field = self._resolve_field(model, lookup, view_name)
+        if field is None or field.primary_key:
+            return
+        reason = '{} {} {}__{}'.format(view_name, source, lookup, lookup_expr)
+        if lookup_expr in TRIGRAM_LOOKUPS:
+            if self.connection.vendor == 'postgresql':
+                self._add(model, (field.column,), 'trigram', reason)
+            else:
+                self.notes.append('{}: "{}__{}" can\'t use an index on {}'.format(
+                    view_name, lookup, lookup_expr, self.connection.vendor))
+            return
+        if lookup_expr in BTREE_LOOKUPS:
+            self._add(model, self._get_tenant_columns(model) + (field.column,), 'btree', reason)
+
+    # declarations of a view
+
+    def _get_ordering_lookups(self, view_cls, attrs, model):
+        lookups = []
+        ordering_fields = attrs.get('ordering_fields', getattr(view_cls, 'ordering_fields', None))
+        if ordering_fields == '__all__':
+            lookups.extend(f.name for f in model._meta.concrete_fields)
+        elif ordering_fields:
+            lookups.extend(ordering_fields)
+        ordering = attrs.get('ordering', getattr(view_cls, 'ordering', None))
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        lookups.extend(ordering or ())
+        extra_fields = attrs.get('extra_ordering_fields', getattr(view_cls, 'extra_ordering_fields', None)) or {}
+        for value in extra_fields.values():
+            if isinstance(value, str):
+                value = (value,)
+            if isinstance(value, (list, tuple)):
+                lookups.extend(v for v in value if isinstance(v, str))
+        return lookups
+
+    def _get_filterset_lookups(self, filterset_class):
+        for filter_ in filterset_class.base_filters.values():
+            if isinstance(filter_, FilterSetOrderingFilter):
+                # ExtendedOrderingFilter maps field names to lookups (or callables building expressions)
+                ordering_map = getattr(filter_, 'ordering_map', {})
+                for field_name in filter_.param_map.values():
+                    value = ordering_map.get(field_name, field_name)
+                    if isinstance(value, str):
+                        value = (value,)
+                    if isinstance(value, (list, tuple)):
+                        for lookup in value:
+                            yield 'order', lookup, None
+                continue
+            if filter_.field_name:
+                yield 'filter', filter_.field_name, filter_.lookup_expr
+
+    def analyse_view(self, route, view_cls, attrs):
+        model = self._get_model(view_cls, attrs)
+        if model is None:
+            return
+        view_name = view_cls.__name__
+        backends = attrs.get('filter_backends', view_cls.filter_backends) or ()
+
+        if any(issubclass(b, OrderingFilter) for b in backends):
+            for lookup in self._get_ordering_lookups(view_cls, attrs, model):
+                self.add_ordering(model, lookup, view_name)
+
+        search_fields = attrs.get('search_fields', getattr(view_cls, 'search_fields', None))
+        if any(issubclass(b, SearchFilter) for b in backends) and search_fields:
+            if any(issubclass(b, FullTextSearchFilter) for b in backends) and \
+                    get_search_backend(model, self.using) is not None:
+                # searches are served by the search index of the model
+                pass
+            elif isinstance(search_fields, str):
+                self.notes.append('{}: search_fields is the string "{}", it must be a list of fields'.format(
+                    view_name, search_fields))
+            else:
+                for search_field in search_fields:
+                    lookup_expr = SEARCH_LOOKUPS.get(search_field[0], 'icontains')
+                    lookup = search_field.lstrip('^=@$')
+                    if lookup_expr in ('search', 'iregex'):
+                        continue
+                    self.add_filter(model, lookup, lookup_expr, view_name, source='search')
+
+        filterset_class = attrs.get('filterset_class', getattr(view_cls, 'filterset_class', None))
+        if filterset_class is not None:
+            if not any(issubclass(b, DjangoFilterBackend) for b in backends):
+                self.notes.append('{}: filterset_class {} is not used, DjangoFilterBackend is not in '
+                                  'filter_backends'.format(view_name, filterset_class.__name__))
+            else:
+                filter_model = getattr(filterset_class._meta, 'model', None) or model
+                for kind, lookup, lookup_expr in self._get_filterset_lookups(filterset_class):
+                    if kind == 'order':
+                        self.add_ordering(filter_model, lookup, view_name)
+                    else:
+                        self.add_filter(filter_model, lookup, lookup_expr, view_name)
+
+    def analyse(self):
+        seen = set()
+        for route, view_cls, initkwargs in self.iter_list_views():
+            key = (view_cls, tuple(sorted(initkwargs)))
+            if key in seen:
+                continue
+            seen.add(key)
+            self.analyse_view(route, view_cls, initkwargs)
+        self.check_existing()
+        return list(self.candidates.values())
+
+    # database
+
+    def _get_constraints(self, table):
+        with self.connection.cursor() as cursor:
+            return self.connection.introspection.get_constraints(cursor, table)
+
+    def check_existing(self):
+        constraints = {}
+        schema_editor = self.connection.schema_editor()
+        for candidate in self.candidates.values():
+            if candidate.table not in constraints:
+                constraints[candidate.table] = self._get_constraints(candidate.table)
+            suffix = '_api_trgm' if candidate.kind == 'trigram' else '_api'
+            candidate.name = schema_editor._create_index_name(candidate.table, candidate.columns, suffix=suffix)
+            for name, constraint in constraints[candidate.table].items():
+                if name == candidate.name:
+                    candidate.covered_by = name
+                    break
+                if candidate.kind != 'btree' or not (constraint['index'] or constraint['unique']):
+                    continue
+                prefix = candidate.required_prefix
+                if tuple(constraint['columns'][:len(prefix)]) == prefix:
+                    candidate.covered_by = name
+                    break
+
+    # output
+
+    def get_sql(self, candidate):
+        """ return (sql, reverse_sql) creating the index of ``candidate`` """
+        quote = self.connection.ops.quote_name
+        vendor = self.connection.vendor
+        if candidate.kind == 'trigram':
+            columns = ', '.join('UPPER({}::text) gin_trgm_ops'.format(quote(c)) for c in candidate.columns)
+            sql = 'CREATE INDEX IF NOT EXISTS {} ON {} USING gin ({})'.format(
+                quote(candidate.name), quote(candidate.table), columns)
+        else:
+            sql = 'CREATE INDEX {}{} ON {} ({})'.format(
+                '' if vendor == 'mysql' else 'IF NOT EXISTS ', quote(candidate.name), quote(candidate.table),
+                ', '.join(quote(c) for c in candidate.columns))
+        if vendor == 'mysql':
+            reverse_sql = 'DROP INDEX {} ON {}'.format(quote(candidate.name), quote(candidate.table))
+        else:
+            reverse_sql = 'DROP INDEX IF EXISTS {}'.format(quote(candidate.name))
+        return sql, reverse_sql
+
+    def build_migrations(self, name='api_indexes'):
+        """
+        return {app_label: Migration} creating missing indexes of project apps.
+        models of third party apps are skipped, their migrations can't be edited.
+        """
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        base_dir = str(settings.BASE_DIR)
+        operations = OrderedDict()
+        for candidate in self.candidates.values():
+            if candidate.covered_by:
+                continue
+            app_config = candidate.model._meta.app_config
+            if not os.path.abspath(app_config.path).startswith(base_dir):
+                self.notes.append('{}: {} is in a third party app, create the index manually'.format(
+                    candidate.name, candidate.model._meta.label))
+                continue
+            app_operations = operations.setdefault(app_config.label, [])
+            if candidate.kind == 'trigram' and not any(isinstance(op, migrations.RunSQL) and 'pg_trgm' in op.sql
+                                                       for op in app_operations):
+                app_operations.insert(0, migrations.RunSQL('CREATE EXTENSION IF NOT EXISTS pg_trgm',
+                                                           migrations.RunSQL.noop))
+            sql, reverse_sql = self.get_sql(candidate)
+            app_operations.append(migrations.RunSQL(sql, reverse_sql))
+
+        result = OrderedDict()
+        for app_label, app_operations in operations.items():
+            leaf_nodes = loader.graph.leaf_nodes(app_label)
+            number = max([MigrationAutodetector.parse_number(leaf) or 0 for _, leaf in leaf_nodes] or [0]) + 1
+            migration = migrations.Migration('%04i_%s' % (number, name), app_label)
+            migration.dependencies = list(leaf_nodes)
+            migration.operations = app_operations
+            result[app_label] = migration
+        return result
+
+    @staticmethod
+    def write_migration(migration):
+        writer = MigrationWriter(migration)
+        with open(writer.path, 'w', encoding='utf-8') as f:
+            f.write(writer.as_string())
+        return writer.path
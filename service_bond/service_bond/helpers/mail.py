@@ -0,0 +1,119 @@
+import concurrent.futures
+import functools
+import itertools
+import os
+import threading
+import traceback
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import close_old_connections
+from django.template.loader import get_template
+from django.utils.html import strip_tags
+
+from service_bond.helpers.cache import LRUCache
+
+print = functools.partial(print, flush=True)
+
+
+def _context_key(context):
+    """ a hashable key of a context, None if a value is not hashable """
+    try:
+        key = tuple(sorted(context.items()))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class BulkMailer(object):
+    """
+    Send one templated email to many recipients.
+
+    ``recipients`` are email addresses or (email address, context) pairs, the context of a recipient is added to
+    the shared context. the template is compiled once and rendered once per distinct recipient context, i.e.
+    recipients without their own context share one render. messages are sent over one connection of
+    ``backend`` (EMAIL_BACKEND by default), ``EMAIL_BULK_CHUNK_SIZE`` messages per call of the backend.
+    ``send`` blocks, ``dispatch`` sends in background and returns a future of the number of sent messages.
+    """
+
+    def __init__(self, backend=None, chunk_size=None):
+        self.backend = backend
+        self.chunk_size = chunk_size or getattr(settings, 'EMAIL_BULK_CHUNK_SIZE', 500)
+        self._templates = LRUCache(maxsize=128)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_template(self, template_name):
+        if settings.DEBUG:
+            # templates are edited while debugging
+            return get_template(template_name)
+        return self._templates.get_or_set(template_name, lambda: get_template(template_name))
+
+    def build_messages(self, subject, template_name, recipients, context=None, from_email=None, html=True,
+                       connection=None):
+        """ yield a message per recipient, see the class docstring """
+        template = self.get_template(template_name)
+        context = context or {}
+        from_email = from_email or settings.DEFAULT_FROM_EMAIL
+        renders = {}
+        for recipient in recipients:
+            email, extra = (recipient, {}) if isinstance(recipient, str) else recipient
+            key = _context_key(extra)
+            body = renders.get(key) if key is not None else None
+            if body is None:
+                body = template.render(dict(context, **extra))
+                if key is not None:
+                    renders[key] = body
+            message = EmailMultiAlternatives(subject, strip_tags(body) if html else body, from_email, [email],
+                                             connection=connection)
+            if html:
+                message.attach_alternative(body, 'text/html')
+            yield message
+
+    def send(self, subject, template_name, recipients, context=None, from_email=None, html=True,
+             fail_silently=False):
+        """ send the messages over one connection, return the number of sent messages """
+        connection = get_connection(self.backend, fail_silently=fail_silently)
+        messages = self.build_messages(subject, template_name, recipients, context=context, from_email=from_email,
+                                       html=html, connection=connection)
+        sent = 0
+        with connection:
+            while True:
+                chunk = list(itertools.islice(messages, self.chunk_size))
+                if not chunk:
+                    break
+                sent += connection.send_messages(chunk) or 0
+        return sent
+
+    @property
+    def executor(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # threads don't survive a fork, a forked worker starts its own thread
+                    self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='bulk-mail')
+                    self._pid = pid
+        return self._executor
+
+    def _run(self, *args, **kwargs):
+        try:
+            close_old_connections()
+            return self.send(*args, **kwargs)
+        except Exception:
+            traceback.print_exc()
+            print('sending bulk email "{}" failed'.format(args[0]))
+            raise
+        finally:
+            close_old_connections()
+
+    def dispatch(self, subject, template_name, recipients, context=None, from_email=None, html=True,
+                 fail_silently=False):
+        """ send in background, see send. the context must stay valid out of the request (no lazy querysets) """
+        return self.executor.submit(self._run, subject, template_name, list(recipients), context=context,
+                                    from_email=from_email, html=html, fail_silently=fail_silently)
+
+
+bulk_mailer = BulkMailer()
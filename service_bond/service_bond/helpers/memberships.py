@@ -0,0 +1,117 @@
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_init, post_save
+
+from service_bond.helpers.cache import LRUCache
+
+
+class MembershipCache(object):
+    """
+    Cache of "user is a member of shop" answers, used by shopCustomerPermission.
+
+    answers are kept in an in-process LRU and in a shared django cache (``MEMBERSHIP_CACHE_ALIAS``), negative
+    answers expire sooner. ``warm`` loads all shops of a user with one query, then every shop of that user is
+    answered without a query. a membership change invalidates the shared entries and the entries of the current
+    process, other processes may answer from their LRU for at most ``MEMBERSHIP_CACHE_LOCAL_TTL`` seconds.
+    memberships are rows of ``SHOP_MEMBERSHIP_MODEL`` having ``user`` and ``shop`` foreign keys.
+    """
+    KEY_PREFIX = 'shop-membership'
+
+    def __init__(self, maxsize=None, ttl=None, local_ttl=None, negative_ttl=None, cache_alias=None):
+        self.ttl = ttl or getattr(settings, 'MEMBERSHIP_CACHE_TTL', 300)
+        self.local_ttl = local_ttl or getattr(settings, 'MEMBERSHIP_CACHE_LOCAL_TTL', 30)
+        self.negative_ttl = negative_ttl or getattr(settings, 'MEMBERSHIP_CACHE_NEGATIVE_TTL', 30)
+        self.cache_alias = cache_alias or getattr(settings, 'MEMBERSHIP_CACHE_ALIAS', 'default')
+        self._local = LRUCache(maxsize or getattr(settings, 'MEMBERSHIP_CACHE_SIZE', 4096), ttl=self.local_ttl)
+
+    @property
+    def model(self):
+        label = getattr(settings, 'SHOP_MEMBERSHIP_MODEL', None)
+        return apps.get_model(label) if label else None
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def _pair_key(self, user_id, shop_id):
+        return '{}:{}:{}'.format(self.KEY_PREFIX, user_id, shop_id)
+
+    def _user_key(self, user_id):
+        return '{}:{}:*'.format(self.KEY_PREFIX, user_id)
+
+    def _set(self, key, value, ttl):
+        self._local.set(key, value, ttl=min(ttl, self.local_ttl))
+        self.shared.set(key, value, ttl)
+
+    def is_member(self, user_id, shop_id):
+        pair_key, user_key = self._pair_key(user_id, shop_id), self._user_key(user_id)
+        value = self._local.get(pair_key, LRUCache.MISSING)
+        if value is not LRUCache.MISSING:
+            return value
+        shop_ids = self._local.get(user_key)
+        if shop_ids is not None:
+            return shop_id in shop_ids
+
+        shared = self.shared.get_many([pair_key, user_key])
+        if pair_key in shared:
+            self._local.set(pair_key, shared[pair_key], ttl=self.local_ttl if shared[pair_key] else
+                            min(self.negative_ttl, self.local_ttl))
+            return shared[pair_key]
+        if user_key in shared:
+            shop_ids = frozenset(shared[user_key])
+            self._local.set(user_key, shop_ids)
+            return shop_id in shop_ids
+
+        value = self.model._base_manager.filter(user_id=user_id, shop_id=shop_id).exists()
+        self._set(pair_key, value, self.ttl if value else self.negative_ttl)
+        return value
+
+    def warm(self, user_id):
+        """ load all shops of a user with one query, return their ids """
+        shop_ids = frozenset(self.model._base_manager.filter(user_id=user_id).values_list('shop_id', flat=True))
+        self._set(self._user_key(user_id), shop_ids, self.ttl)
+        return shop_ids
+
+    def invalidate(self, user_id, shop_id=None):
+        keys = [self._user_key(user_id)]
+        if shop_id is not None:
+            keys.append(self._pair_key(user_id, shop_id))
+        for key in keys:
+            self._local.pop(key)
+        self.shared.delete_many(keys)
+
+    def clear(self):
+        """ clear entries of this process, shared entries expire by their ttl """
+        self._local.clear()
+
+
+membership_cache = MembershipCache()
+
+
+def _remember_membership(sender, instance, **kwargs):
+    instance._membership_loaded = (instance.user_id, instance.shop_id)
+
+
+def _invalidate_membership(sender, instance, **kwargs):
+    # a changed row invalidates its previous (user, shop) pair too
+    pairs = {getattr(instance, '_membership_loaded', None), (instance.user_id, instance.shop_id)}
+    for user_id, shop_id in filter(None, pairs):
+        if user_id is not None:
+            membership_cache.invalidate(user_id, shop_id)
+    instance._membership_loaded = (instance.user_id, instance.shop_id)
+
+
+def _warm_memberships(sender, user, **kwargs):
+    if membership_cache.model is not None:
+        membership_cache.warm(user.pk)
+
+
+def connect_membership_signals():
+    label = getattr(settings, 'SHOP_MEMBERSHIP_MODEL', None)
+    if label:
+        post_init.connect(_remember_membership, sender=label, dispatch_uid='membership_cache_post_init')
+        post_save.connect(_invalidate_membership, sender=label, dispatch_uid='membership_cache_post_save')
+        post_delete.connect(_invalidate_membership, sender=label, dispatch_uid='membership_cache_post_delete')
+        user_logged_in.connect(_warm_memberships, dispatch_uid='membership_cache_warm')
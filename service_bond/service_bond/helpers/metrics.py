@@ -0,0 +1,192 @@
+import glob
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from django.conf import settings
+
+_INT = struct.Struct('<i')
+_DOUBLE = struct.Struct('<d')
+_HEADER_SIZE = 8
+
+
+def _padded_key(encoded):
+    return encoded + b' ' * (8 - (len(encoded) + _INT.size) % 8)
+
+
+def _read_all_values(data, used):
+    """ yield (key, value, value position) of all entries stored in ``data`` """
+    pos = _HEADER_SIZE
+    while pos < used:
+        key_length = _INT.unpack_from(data, pos)[0]
+        pos += _INT.size
+        key = bytes(data[pos:pos + key_length]).decode('utf-8')
+        pos += len(_padded_key(b' ' * key_length))
+        value = _DOUBLE.unpack_from(data, pos)[0]
+        yield key, value, pos
+        pos += _DOUBLE.size
+
+
+class MmapedDict(object):
+    """
+    A dict of float values stored in a memory mapped file.
+
+    every process writes to its own file, so workers never need to lock each other. other processes
+    only read the files. file format: a 4 bytes "used size" header padded to 8 bytes, then entries of
+    key length (int32), utf-8 key padded to 8 bytes alignment and value (float64).
+    """
+    INITIAL_SIZE = 1 << 16
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._f = open(filename, 'a+b')
+        self._capacity = os.fstat(self._f.fileno()).st_size
+        if self._capacity == 0:
+            self._f.truncate(self.INITIAL_SIZE)
+            self._capacity = self.INITIAL_SIZE
+        self._m = mmap.mmap(self._f.fileno(), self._capacity)
+        self._positions = {}
+        self._used = _INT.unpack_from(self._m, 0)[0]
+        if self._used == 0:
+            self._used = _HEADER_SIZE
+            _INT.pack_into(self._m, 0, self._used)
+        else:
+            for key, _, pos in _read_all_values(self._m, self._used):
+                self._positions[key] = pos
+
+    def _init_value(self, key):
+        encoded = key.encode('utf-8')
+        padded = _padded_key(encoded)
+        entry = _INT.pack(len(encoded)) + padded + _DOUBLE.pack(0.0)
+        if self._used + len(entry) > self._capacity:
+            while self._used + len(entry) > self._capacity:
+                self._capacity *= 2
+            self._f.truncate(self._capacity)
+            # the old mapping is not used anymore (callers hold the lock), a mapping is kept until it's closed
+            self._m.close()
+            self._m = mmap.mmap(self._f.fileno(), self._capacity)
+        self._m[self._used:self._used + len(entry)] = entry
+        self._positions[key] = self._used + len(entry) - _DOUBLE.size
+        self._used += len(entry)
+        # the header is updated last, readers never see a partially written entry
+        _INT.pack_into(self._m, 0, self._used)
+
+    def inc(self, key, amount=1.0):
+        with self._lock:
+            pos = self._positions.get(key)
+            if pos is None:
+                self._init_value(key)
+                pos = self._positions[key]
+            _DOUBLE.pack_into(self._m, pos, _DOUBLE.unpack_from(self._m, pos)[0] + amount)
+
+    @staticmethod
+    def read_all_values(filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if len(data) < _HEADER_SIZE:
+            return
+        yield from ((key, value) for key, value, _ in _read_all_values(data, _INT.unpack_from(data, 0)[0]))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_key(name, labels):
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, _escape_label(v)) for k, v in labels))
+
+
+def _pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class RequestMetrics(object):
+    """
+    Request latency histograms and in-flight gauges shared by all workers of a host.
+
+    values are kept in per-process memory mapped files in ``METRICS_DIR`` and aggregated when rendered,
+    in prometheus text format. counters of exited workers are kept, their in-flight gauges are ignored.
+    ``METRICS_DIR`` should be emptied when the server (not a worker) restarts.
+    """
+    DURATION = 'http_request_duration_seconds'
+    IN_FLIGHT = 'http_requests_in_flight'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, directory=None, buckets=None):
+        self.directory = directory or getattr(settings, 'METRICS_DIR', None) or \
+            os.path.join(tempfile.gettempdir(), 'service_bond_metrics')
+        self.buckets = tuple(sorted(buckets or getattr(settings, 'METRICS_LATENCY_BUCKETS', self.DEFAULT_BUCKETS)))
+        self._pid = None
+        self._counters = None
+        self._gauges = None
+        self._lock = threading.Lock()
+
+    def _get_files(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # first use in this process, or the process was forked after first use
+            with self._lock:
+                if self._pid != pid:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._counters = MmapedDict(os.path.join(self.directory, 'counters_{}.db'.format(pid)))
+                    self._gauges = MmapedDict(os.path.join(self.directory, 'gauges_{}.db'.format(pid)))
+                    self._pid = pid
+        return self._counters, self._gauges
+
+    def observe(self, view, method, status, duration):
+        counters, _ = self._get_files()
+        labels = (('view', view), ('method', method), ('status', status))
+        for bucket in self.buckets:
+            # all buckets are written, so every label set has its buckets stored in increasing order
+            counters.inc(_format_key(self.DURATION + '_bucket', labels + (('le', repr(float(bucket))),)),
+                         1.0 if duration <= bucket else 0.0)
+        counters.inc(_format_key(self.DURATION + '_bucket', labels + (('le', '+Inf'),)))
+        counters.inc(_format_key(self.DURATION + '_sum', labels), duration)
+        counters.inc(_format_key(self.DURATION + '_count', labels))
+
+    def in_flight(self, view, amount):
+        _, gauges = self._get_files()
+        gauges.inc(_format_key(self.IN_FLIGHT, (('view', view),)), amount)
+
+    def collect(self):
+        """ return aggregated values of all workers as a dict of 'name{labels}' -> value """
+        values = {}
+        for filename in sorted(glob.glob(os.path.join(self.directory, '*.db'))):
+            kind, pid = os.path.splitext(os.path.basename(filename))[0].split('_', 1)
+            if kind == 'gauges' and not _pid_is_alive(int(pid)):
+                continue
+            try:
+                for key, value in MmapedDict.read_all_values(filename):
+                    values[key] = values.get(key, 0.0) + value
+            except OSError:
+                continue
+        return values
+
+    def render(self):
+        lines = [
+            '# HELP {} Request latency per view, method and status.'.format(self.DURATION),
+            '# TYPE {} histogram'.format(self.DURATION),
+        ]
+        gauge_lines = [
+            '# HELP {} Requests currently processed per view.'.format(self.IN_FLIGHT),
+            '# TYPE {} gauge'.format(self.IN_FLIGHT),
+        ]
+        for key, value in self.collect().items():
+            line = '{} {}'.format(key, repr(value))
+            if key.startswith(self.IN_FLIGHT):
+                gauge_lines.append(line)
+            else:
+                lines.append(line)
+        return '\n'.join(lines + gauge_lines) + '\n'
+
+
+request_metrics = RequestMetrics()
@@ -1,86 +1,195 @@
+import asyncio
+import contextlib
 import functools
 import logging
-import os
+import random
 import re
 import sys
-import traceback
-import types
+import threading
+import time
 import uuid
 import datetime
-from importlib import import_module
 
-import simplejson as json
+from asgiref.sync import async_to_sync, sync_to_async
 from django.conf import settings
 
-from django.db import connection
-from django.urls import set_urlconf
+from django.db import connections
+from django.urls import URLResolver, set_script_prefix, set_urlconf
+from django.urls.resolvers import RegexPattern
 from django_multitenant.utils import set_current_tenant, unset_current_tenant
 from reversion.middleware import RevisionMiddleware
 
+from service_bond.helpers.build_info import build_metadata
+from service_bond.helpers.cache import LRUCache
+from service_bond.helpers.metrics import request_metrics
+from service_bond.helpers.profiling import QueryProfile, query_report
+from service_bond.helpers.revisions import RevisionCapture, revision_writer, write_revisions
+from service_bond.helpers.tenants import tenant_registry
+
 print = functools.partial(print, flush=True)
+logger = logging.getLogger(__name__)
+
+
+def call_on_close(response, func):
+    """ call ``func`` when the server closes ``response``, before its own close (i.e: request_finished) """
+    close = response.close
+
+    def close_response():
+        try:
+            func()
+        finally:
+            close()
 
+    response.close = close_response
 
-class DisableCSRFMiddleware(object):
+
+class DualModeMiddleware(object):
+    """
+    Base class of middlewares which run natively in both sync (wsgi) and async (asgi) handlers,
+    so django doesn't have to adapt them with ``sync_to_async`` thread hops.
+
+    subclasses implement ``process_request(request)``, which may return a response, and
+    ``process_response(request, response)``. both are called directly from async code so they must not block.
+    a ``process_view`` method of a subclass is exposed as a coroutine function in async mode.
+    """
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # same trick as django MiddlewareMixin, the instance is detected as a coroutine function
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            process_view = getattr(self, 'process_view', None)
+            if process_view is not None:
+                async def async_process_view(*args, **kwargs):
+                    return process_view(*args, **kwargs)
+                self.process_view = async_process_view
+
+    def process_request(self, request):
+        return None
+
+    def process_response(self, request, response):
+        return response
 
     def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        response = self.process_request(request)
+        if response is None:
+            response = self.get_response(request)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return self.process_response(request, response)
+
+    def get_sync_response(self, request):
+        """
+        call the rest of the chain from sync code. in async mode this must be called in a thread started by
+        ``sync_to_async(thread_sensitive=True)``, then sync views run in that same thread and
+        see its thread locals (db connections, reversion context).
+        """
+        if self.is_async:
+            return async_to_sync(self.get_response)(request)
+        return self.get_response(request)
+
+
+class DisableCSRFMiddleware(DualModeMiddleware):
+
+    def process_request(self, request):
         if getattr(settings, 'CSRF_DISABLED', False):
             setattr(request, '_dont_enforce_csrf_checks', True)
 
-        response = self.get_response(request)
-        return response
 
-
-class InjectUiVersionInHeadersMiddleware(object):
+class InjectUiVersionInHeadersMiddleware(DualModeMiddleware):
+    """ add version headers of the running build (ui version, static manifest hash, build id) to responses """
 
     def __init__(self, get_response):
-        self.get_response = get_response
-
-    def _get_ui_version(self):
-        ui_packages_path = os.path.join(settings.BASE_DIR, 'FRONTEND', 'service_bond_ui', 'package.json')
-        if not os.path.exists(ui_packages_path):
-            return
-        version = None
-        try:
-            with open(ui_packages_path) as f:
-                data = json.load(f)
-            version = data.get('version')
-        except Exception:
-            traceback.print_exc()
-        return version
+        super(InjectUiVersionInHeadersMiddleware, self).__init__(get_response)
+        # load build metadata at worker start instead of on the first request
+        build_metadata.as_dict()
 
-    def __call__(self, request):
-        response = self.get_response(request)
-        ui_version = self._get_ui_version()
-        if ui_version:
-            response['X-UI-Version'] = ui_version
-        else:
-            print('Cannot discover UI version!')
+    def process_response(self, request, response):
+        for header, value in build_metadata.headers():
+            response[header] = value
         return response
 
 
-class SqlQueryLogging:
+class QueryProfilerMiddleware(DualModeMiddleware):
+    """
+    Profile sql queries of a sample of requests.
+
+    for sampled requests ``X-Query-Count`` and ``X-Query-Time`` (milliseconds) headers are added to the response,
+    statements are fingerprinted and a fingerprint repeated ``QUERY_PROFILER_N1_THRESHOLD`` times in one request
+    is reported as a N+1 candidate with its call site. results are collected per view in
+    ``service_bond.helpers.profiling.query_report``.
+    """
+
     def __init__(self, get_response):
-        self.get_response = get_response
+        super(QueryProfilerMiddleware, self).__init__(get_response)
+        self.sample_rate = getattr(settings, 'QUERY_PROFILER_SAMPLE_RATE', 0.0)
+        self.n1_threshold = getattr(settings, 'QUERY_PROFILER_N1_THRESHOLD', 5)
+
+    @staticmethod
+    def get_view_name(request, view_func):
+        view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+        if view_class is None:
+            return '{}.{}'.format(view_func.__module__, view_func.__qualname__)
+        actions = getattr(view_func, 'actions', None) or {}
+        action = actions.get(request.method.lower())
+        return '{}.{}'.format(view_class.__name__, action) if action else view_class.__name__
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._query_profiler_view = self.get_view_name(request, view_func)
+
+    def is_sampled(self):
+        return self.sample_rate and random.random() < self.sample_rate
 
     def __call__(self, request):
-        response = self.get_response(request)
-        from sys import stdout
-        if stdout.isatty():
-            for query in connection.queries:
-                print("\033[1;31m[%s]\033[0m \033[1m%s\033[0m" % (query['time'], " ".join(query['sql'].split())))
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.is_sampled():
+            return self.get_response(request)
+        return self.profile_request(request)
+
+    async def __acall__(self, request):
+        if not self.is_sampled():
+            return await self.get_response(request)
+        # db connections are thread local, the execute wrappers must be installed in the thread running the view
+        return await sync_to_async(self.profile_request, thread_sensitive=True)(request)
+
+    def profile_request(self, request):
+        profile = QueryProfile(n1_threshold=self.n1_threshold)
+        with contextlib.ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(profile))
+            response = self.get_sync_response(request)
+
+        response['X-Query-Count'] = str(profile.count)
+        response['X-Query-Time'] = '{:.1f}'.format(profile.duration * 1000)
+        view_name = getattr(request, '_query_profiler_view', None) or '<unresolved>'
+        query_report.add(view_name, profile)
+        for fingerprint, (count, duration) in profile.repeated().items():
+            logger.warning('Possible N+1 query in %s: %d x %s at %s', view_name, count, fingerprint,
+                           ' <- '.join(profile.call_sites.get(fingerprint) or []))
         return response
 
 
-class RequestTimeLoggingMiddleware(object):
-    """Middleware class logging request time to stderr.
+class RequestTimeLoggingMiddleware(DualModeMiddleware):
+    """Middleware class recording request time metrics and logging it to stderr.
 
-    This class can be used to measure time of request processing
-    within Django.  It can be also used to log time spent in
-    middleware and in view itself, by putting middleware multiple
-    times in INSTALLED_MIDDLEWARE.
+    Latency of every request is recorded in a histogram per resolved view
+    name, method and status, and in-flight requests are counted per view
+    (see `service_bond.helpers.metrics'). Metrics are recorded only by the
+    outermost instance of the middleware.
+
+    When DEBUG is on, timing is also logged to stderr. This can be used to
+    log time spent in middleware and in view itself, by putting middleware
+    multiple times in INSTALLED_MIDDLEWARE.
 
     Static method `log_message' may be used independently of the
     middleware itself, outside of it, and even when middleware is not
@@ -125,12 +234,36 @@ class RequestTimeLoggingMiddleware(object):
             ), file=sys.stderr)
 
     def __init__(self, get_response):
-        self.get_response = get_response
+        super(RequestTimeLoggingMiddleware, self).__init__(get_response)
+        self.metrics_enabled = getattr(settings, 'METRICS_ENABLED', True)
 
-    def __call__(self, request):
+    @staticmethod
+    def get_view_name(request):
+        resolver_match = getattr(request, 'resolver_match', None)
+        return resolver_match.view_name if resolver_match else '<unresolved>'
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(request, '_metrics_owner', None) is self and not hasattr(request, '_metrics_view'):
+            request._metrics_view = self.get_view_name(request)
+            request_metrics.in_flight(request._metrics_view, 1)
+
+    def process_request(self, request):
+        if self.metrics_enabled and not hasattr(request, '_metrics_owner'):
+            request._metrics_owner = self
+            request._metrics_start = time.perf_counter()
         if settings.DEBUG:
             self.log_message(request, 'request ')
-        response = self.get_response(request)
+
+    def _end_in_flight(self, request):
+        if getattr(request, '_metrics_owner', None) is self and hasattr(request, '_metrics_view'):
+            request_metrics.in_flight(request._metrics_view, -1)
+            del request._metrics_view
+
+    def process_response(self, request, response):
+        self._end_in_flight(request)
+        if getattr(request, '_metrics_owner', None) is self:
+            request_metrics.observe(self.get_view_name(request), request.method,
+                                    getattr(response, 'status_code', 0), time.perf_counter() - request._metrics_start)
         if settings.DEBUG:
             s = getattr(response, 'status_code', 0)
             r = str(s)
@@ -141,51 +274,175 @@ class RequestTimeLoggingMiddleware(object):
             self.log_message(request, 'response', r)
         return response
 
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        try:
+            return super(RequestTimeLoggingMiddleware, self).__call__(request)
+        finally:
+            self._end_in_flight(request)
+
+    async def __acall__(self, request):
+        try:
+            return await super(RequestTimeLoggingMiddleware, self).__acall__(request)
+        finally:
+            self._end_in_flight(request)
+
 
 class CustomRevisionMiddleware(RevisionMiddleware):
+    """
+    RevisionMiddleware usable in async handlers too, with configurable capture mode (REVISION_CAPTURE_MODE):
+
+    - ``sync``: default reversion behaviour, objects are serialized and saved inside the request.
+    - ``after_response``: only the field values of objects are copied when they are saved in the request. they are
+      serialized (with the objects they follow) and the revision is saved when the response is closed, before the
+      worker handles its next request.
+    - ``background``: like ``after_response`` but revisions are serialized and written in batches by a background
+      thread. pending revisions are flushed at worker shutdown, they are lost if the worker is killed.
+
+    requests with safe methods never create a revision. in ``sync`` mode the revision context of reversion is
+    thread local, so in async handlers requests creating a revision go through one thread hop.
+    """
+    CAPTURE_SYNC = 'sync'
+    CAPTURE_AFTER_RESPONSE = 'after_response'
+    CAPTURE_BACKGROUND = 'background'
+
     atomic = False
+    sync_capable = True
+    async_capable = True
 
+    def __init__(self, get_response):
+        self.capture_mode = getattr(settings, 'REVISION_CAPTURE_MODE', self.CAPTURE_SYNC)
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        # rest of the chain, not wrapped in a revision context
+        self.next_response = get_response
+        if self.is_async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            get_response = async_to_sync(get_response)
+        super(CustomRevisionMiddleware, self).__init__(get_response)
 
-logger = logging.getLogger(__name__)
+    @staticmethod
+    def _get_user(request):
+        user = getattr(request, 'user', None)
+        return user if user is not None and user.is_authenticated else None
+
+    @staticmethod
+    def _write_revisions(captures):
+        try:
+            write_revisions(captures)
+        except Exception:
+            logger.exception('Cannot save revisions')
+
+    def _defer_revision(self, capture, user, response):
+        capture.user = user
+        if self.capture_mode == self.CAPTURE_BACKGROUND:
+            revision_writer.put(capture)
+        else:
+            call_on_close(response, functools.partial(self._write_revisions, [capture]))
 
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if self.capture_mode == self.CAPTURE_SYNC or not self.request_creates_revision(request):
+            return self.get_response(request)
+
+        with RevisionCapture() as capture:
+            response = self.next_response(request)
+        if response.status_code < 400 and capture.objects:
+            self._defer_revision(capture, self._get_user(request), response)
+        return response
 
-class SubpathURLRoutingMiddleware(object):
+    async def __acall__(self, request):
+        if not self.request_creates_revision(request):
+            return await self.next_response(request)
+        if self.capture_mode == self.CAPTURE_SYNC:
+            return await sync_to_async(self.get_response, thread_sensitive=True)(request)
+
+        with RevisionCapture() as capture:
+            response = await self.next_response(request)
+        if response.status_code < 400 and capture.objects:
+            user = await sync_to_async(self._get_user, thread_sensitive=True)(request)
+            self._defer_revision(capture, user, response)
+        return response
+
+
+class ShopSubpathPattern(RegexPattern):
     """
-    A middleware class that adds a ``subpath`` attribute to the current request.
+    Matches the ``shop/<id>/`` prefix of shop urls, for every shop. the shop id is captured as ``shop_id`` but
+    isn't passed to views, the middleware sets the shop as the current tenant.
+
+    urls are reversed without the prefix: SubpathURLRoutingMiddleware adds ``shop/<id>/`` of the current shop to
+    the script prefix. so one urlconf and one resolver serve all shops, whatever their number.
     """
+    SHOP_REGEX = re.compile(r'^shop/(?P<shop_id>\d+)/')
 
-    def __init__(self, get_response):
-        self.get_response = get_response
+    def __init__(self):
+        # the regex used to reverse urls
+        super(ShopSubpathPattern, self).__init__(r'^')
 
-    def __call__(self, request):
+    def match(self, path):
+        match = self.SHOP_REGEX.search(path)
+        if match:
+            return path[match.end():], (), {}
+        return None
+
+    def __str__(self):
+        return 'shop/<shop_id>/'
+
+
+def shop_subpath(urlpatterns):
+    """ patterns served under ``shop/<id>/``, see ShopSubpathPattern """
+    return URLResolver(ShopSubpathPattern(), urlpatterns)
+
+
+def _get_script_name(request):
+    return request.path[:len(request.path) - len(request.path_info)].rstrip('/')
+
+
+class SubpathURLRoutingMiddleware(DualModeMiddleware):
+    """
+    A middleware class that adds a ``subpath`` attribute to the current request.
+    """
+
+    def process_request(self, request):
         self.set_subpath(request)
-        response = self.get_response(request)
-        return response
+
+    async def __acall__(self, request):
+        shop = LRUCache.MISSING
+        shop_id = self._get_shop_id(request)
+        if shop_id is not None:
+            # the shop is looked up once, only a shop missing in the registry needs a query (and a thread hop).
+            # set_subpath must not look it up again, it may expire in between and query in async context
+            shop = tenant_registry.get_cached(shop_id)
+            if shop is LRUCache.MISSING:
+                shop = await sync_to_async(tenant_registry.get, thread_sensitive=True)(shop_id)
+        self.set_subpath(request, shop=shop)
+        response = await self.get_response(request)
+        return self.process_response(request, response)
 
     @staticmethod
-    def _load_shop_urlconf(url_conf, shop_id, request):
-        from service_bond.urls_shop import urlpatterns
-        from apps.administration.models import Shop
-        try:
-            Shop = Shop.all_objects.get(id=shop_id)
-        except (Shop.DoesNotExist, ValueError, TypeError):
-            shop = None
-        urlconf_module = None
-        if Shop:
-            urlconf_module = types.ModuleType('{}{}'.format(url_conf, Shop.id))
-            urlconf_module.urlpatterns = []
-            for p in urlpatterns:
-                p.pattern._regex = re.sub('^shop/\d+', 'shop/{}'.format(Shop.id), p.pattern._regex)
-                p.pattern.regex = re.compile(p.pattern._regex)
-                urlconf_module.urlpatterns.append(p)
-
-        request.Shop = Shop
-        set_current_tenant(request.Shop)
-        return urlconf_module
-
-    def set_subpath(self, request):
+    def _get_shop_id(request):
+        splitted_path = request.path_info.lstrip('/').split('/', 2)
+        if splitted_path[0] == 'shop' and len(splitted_path) > 1:
+            return splitted_path[1]
+        return None
+
+    @staticmethod
+    def _load_shop_urlconf(url_conf, shop_id, request, shop=LRUCache.MISSING):
+        if shop is LRUCache.MISSING:
+            shop = tenant_registry.get(shop_id)
+        request.shop = request.Shop = shop
+        set_current_tenant(shop)
+        if not shop:
+            return None
+        # urls of the shared shop urlconf are reversed under the prefix of this shop
+        set_script_prefix('{}/shop/{}/'.format(_get_script_name(request), shop.id))
+        return url_conf
+
+    def set_subpath(self, request, shop=LRUCache.MISSING):
         """
         Adds a ``subpath`` attribute to the ``request`` parameter.
+        ``shop`` is the shop of a shop subpath if it's looked up already.
         """
         splitted_path = request.path_info.lstrip('/').split('/', 1)
         subpath = splitted_path[0]
@@ -195,12 +452,20 @@ class SubpathURLRoutingMiddleware(object):
             request.subpath = None
 
         urlconf = settings.SUBPATH_URLCONFS.get(request.subpath)
+        # the script prefix is thread local, a previous shop request may have changed it
+        set_script_prefix(_get_script_name(request) + '/')
         if subpath == 'shop':
             shop_id = splitted_path[1].split('/', 1)[0]
-            urlconf = self._load_shop_urlconf(urlconf, shop_id, request)
+            urlconf = self._load_shop_urlconf(urlconf, shop_id, request, shop=shop)
         else:
             unset_current_tenant()
 
         if urlconf is not None:
             logger.debug("Using urlconf %s for subpath: %s", repr(urlconf), repr(request.subpath))
         request.urlconf = urlconf
+
+    def process_response(self, request, response):
+        if getattr(request, 'shop', None):
+            # the response is rendered, urls out of the request aren't reversed under the shop prefix
+            set_script_prefix(_get_script_name(request) + '/')
+        return response
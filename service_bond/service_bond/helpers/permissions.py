@@ -0,0 +1,156 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from service_bond.helpers.cache import LRUCache
+
+USER_VERSION_KEY = 'shop-perms-version:user:{}'
+GLOBAL_VERSION_KEY = 'shop-perms-version:global'
+
+
+def _get_shared_cache():
+    return caches[getattr(settings, 'PERMISSION_CACHE_ALIAS', 'default')]
+
+
+class PermissionCache(object):
+    """
+    Shared cache of (user permissions, group permissions) of users in a shop.
+
+    permissions are stored as bitsets over ``universe`` (the permissions a shop user can have) under a key of
+    (user, tenant, user version, global version). a change of a user's permissions, groups or admin flags sets a
+    new user version, a change of group permissions sets a new global version, so old entries are never read again
+    and simply expire. versions are random tokens, a version evicted from the shared cache is replaced by a new
+    token and never falls back to an old one. entries are kept in an in-process LRU too, only the versions are
+    read from the shared cache in every request.
+
+    versions must be seen by all processes, so nothing is cached if ``PERMISSION_CACHE_ALIAS`` is a local memory
+    (or dummy) cache. permissions are loaded in every request then.
+    """
+
+    def __init__(self, universe, maxsize=None, ttl=None):
+        self.universe = tuple(sorted(universe))
+        self._index = {perm: i for i, perm in enumerate(self.universe)}
+        self.universe_key = hashlib.md5(','.join(self.universe).encode()).hexdigest()[:8]
+        self.ttl = ttl or getattr(settings, 'PERMISSION_CACHE_TTL', 3600)
+        self._local = LRUCache(maxsize or getattr(settings, 'PERMISSION_CACHE_SIZE', 4096), ttl=self.ttl)
+        self._decoded = LRUCache(maxsize=1024)
+
+    def encode(self, perms):
+        bits = 0
+        for perm in perms:
+            index = self._index.get(perm)
+            if index is not None:
+                bits |= 1 << index
+        return bits
+
+    def decode(self, bits):
+        return self._decoded.get_or_set(
+            bits, lambda: frozenset(perm for i, perm in enumerate(self.universe) if bits >> i & 1))
+
+    def get(self, user_id, tenant_id, loader):
+        """
+        return (user permissions, group permissions) as frozensets.
+        ``loader`` is called on a miss, it returns the permissions as two iterables of 'app_label.codename'.
+        """
+        shared = _get_shared_cache()
+        if not is_shared_cache(shared):
+            user_perms, group_perms = loader()
+            return frozenset(user_perms), frozenset(group_perms)
+        user_version_key = USER_VERSION_KEY.format(user_id)
+        versions = get_versions(shared, [user_version_key, GLOBAL_VERSION_KEY])
+        key = 'shop-perms:{}:{}:{}:{}:{}'.format(self.universe_key, user_id, tenant_id,
+                                                 versions[user_version_key], versions[GLOBAL_VERSION_KEY])
+        entry = self._local.get(key)
+        if entry is None:
+            entry = shared.get(key)
+            if entry is None:
+                user_perms, group_perms = loader()
+                entry = (self.encode(user_perms), self.encode(group_perms))
+                shared.set(key, entry, self.ttl)
+            self._local.set(key, entry)
+        return self.decode(entry[0]), self.decode(entry[1])
+
+
+def is_shared_cache(cache):
+    """ False for caches which are not shared by processes """
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def get_versions(shared, keys):
+    """
+    return {key: version} of version keys. a missing version (never set or evicted) is set to a new token,
+    it must never be read as a version which was used before.
+    """
+    versions = shared.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            shared.add(key, uuid.uuid4().hex, None)
+            versions[key] = shared.get(key)
+            if versions[key] is None:
+                # evicted again at once, a token which is used only by this call loads the permissions
+                versions[key] = uuid.uuid4().hex
+    return versions
+
+
+def set_version(key):
+    shared = _get_shared_cache()
+    if is_shared_cache(shared):
+        shared.set(key, uuid.uuid4().hex, None)
+
+
+def bump_user_version(user_id):
+    # after commit, a request reading the new version must also read the new permissions
+    transaction.on_commit(lambda: set_version(USER_VERSION_KEY.format(user_id)))
+
+
+def bump_global_version():
+    transaction.on_commit(lambda: set_version(GLOBAL_VERSION_KEY))
+
+
+def _user_m2m_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        bump_user_version(instance.pk)
+    elif pk_set is None:
+        bump_global_version()
+    else:
+        for user_id in pk_set:
+            bump_user_version(user_id)
+
+
+def _group_permissions_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_global_version()
+
+
+def _user_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    bump_user_version(instance.pk)
+
+
+def _permissions_deleted(sender, **kwargs):
+    bump_global_version()
+
+
+def connect_permission_signals():
+    user_model = settings.AUTH_USER_MODEL
+    m2m_changed.connect(_user_m2m_changed, sender=user_model + '_user_permissions',
+                        dispatch_uid='permission_cache_user_permissions')
+    m2m_changed.connect(_user_m2m_changed, sender=user_model + '_groups', dispatch_uid='permission_cache_user_groups')
+    m2m_changed.connect(_group_permissions_changed, sender='auth.Group_permissions',
+                        dispatch_uid='permission_cache_group_permissions')
+    post_save.connect(_user_saved, sender=user_model, dispatch_uid='permission_cache_user_saved')
+    post_delete.connect(_permissions_deleted, sender='auth.Group', dispatch_uid='permission_cache_group_deleted')
+    post_delete.connect(_permissions_deleted, sender='auth.Permission',
+                        dispatch_uid='permission_cache_permission_deleted')
+
+
+connect_permission_signals()
@@ -0,0 +1,137 @@
+import functools
+import os
+import re
+import threading
+import time
+import traceback
+
+from django.conf import settings
+
+_STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=2048)
+def fingerprint_sql(sql):
+    """
+    normalize a sql statement so that statements which differ only in their parameters have the same fingerprint.
+    i.e: ``SELECT ... WHERE id IN (1, 2, 3)`` and ``SELECT ... WHERE id IN (%s, %s)`` are the same.
+    """
+    sql = _STRING_LITERAL_RE.sub('?', sql)
+    sql = _NUMBER_LITERAL_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('(...)', sql)
+    return _WHITESPACE_RE.sub(' ', sql).strip()
+
+
+def get_call_site(limit=5):
+    """ return the innermost frames of current stack which belong to project code """
+    base_dir = str(settings.BASE_DIR)
+    frames = []
+    for frame in reversed(traceback.extract_stack()[:-1]):
+        filename = frame.filename
+        if not filename.startswith(base_dir) or 'site-packages' in filename or filename == __file__:
+            continue
+        frames.append('{}:{} in {}'.format(os.path.relpath(filename, base_dir), frame.lineno, frame.name))
+        if len(frames) >= limit:
+            break
+    return frames
+
+
+class QueryProfile(object):
+    """
+    Collects executed queries of one request. an instance is installed as a database execute wrapper.
+    when a fingerprint is repeated ``n1_threshold`` times, the call site of the query is recorded.
+    """
+
+    def __init__(self, n1_threshold=5):
+        self.n1_threshold = n1_threshold
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = {}
+        self.call_sites = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.duration += duration
+            fingerprint = fingerprint_sql(sql)
+            stat = self.fingerprints.get(fingerprint)
+            if stat is None:
+                stat = self.fingerprints[fingerprint] = [0, 0.0]
+            stat[0] += 1
+            stat[1] += duration
+            if stat[0] == self.n1_threshold:
+                self.call_sites[fingerprint] = get_call_site()
+
+    def repeated(self):
+        """ fingerprints executed at least ``n1_threshold`` times (N+1 candidates) """
+        return {fp: stat for fp, stat in self.fingerprints.items() if stat[0] >= self.n1_threshold}
+
+
+class QueryReport(object):
+    """
+    Rolling report of sampled requests per view.
+    for every view it keeps the query totals and the worst repeated fingerprints with their call sites.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or getattr(settings, 'QUERY_PROFILER_REPORT_SIZE', 20)
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def add(self, view_name, profile):
+        repeated = profile.repeated()
+        now = time.time()
+        with self._lock:
+            view = self._views.get(view_name)
+            if view is None:
+                view = self._views[view_name] = {
+                    'requests': 0, 'queries': 0, 'max_queries': 0, 'time': 0.0, 'offenders': {}
+                }
+            view['requests'] += 1
+            view['queries'] += profile.count
+            view['max_queries'] = max(view['max_queries'], profile.count)
+            view['time'] += profile.duration
+            offenders = view['offenders']
+            for fingerprint, (count, duration) in repeated.items():
+                offender = offenders.get(fingerprint)
+                if offender is None:
+                    offender = offenders[fingerprint] = {
+                        'sql': fingerprint, 'requests': 0, 'max_repeat': 0, 'time': 0.0, 'call_site': None,
+                    }
+                offender['requests'] += 1
+                offender['max_repeat'] = max(offender['max_repeat'], count)
+                offender['time'] += duration
+                offender['call_site'] = profile.call_sites.get(fingerprint) or offender['call_site']
+                offender['last_seen'] = now
+            if len(offenders) > self.size:
+                worst = sorted(offenders.values(), key=lambda o: (o['max_repeat'], o['time']), reverse=True)
+                view['offenders'] = {o['sql']: o for o in worst[:self.size]}
+
+    def as_dict(self):
+        with self._lock:
+            result = {}
+            for view_name, view in self._views.items():
+                offenders = sorted(view['offenders'].values(), key=lambda o: (o['max_repeat'], o['time']),
+                                   reverse=True)
+                result[view_name] = {
+                    'requests': view['requests'],
+                    'avg_queries': view['queries'] / view['requests'],
+                    'max_queries': view['max_queries'],
+                    'avg_time': view['time'] / view['requests'],
+                    'offenders': [dict(o) for o in offenders],
+                }
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+
+query_report = QueryReport()
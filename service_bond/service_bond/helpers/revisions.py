@@ -0,0 +1,94 @@
+import contextvars
+from collections import OrderedDict
+
+import reversion
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save
+from django.utils import timezone
+from django.utils.encoding import force_str
+
+from service_bond.helpers.background import BatchWriter
+
+_current_capture = contextvars.ContextVar('revision_capture', default=None)
+
+
+class RevisionCapture(object):
+    """
+    Change set of one request: the registered objects saved (or whose m2m relations changed) while the capture is
+    active. only the concrete field values of an object are copied when it's saved, a later save of the object in
+    the request replaces them. serializing the objects and the objects they follow is deferred to
+    ``write_revisions``, followed objects and m2m relations are serialized as they are when the revision is written.
+    """
+
+    def __init__(self):
+        self.objects = OrderedDict()
+        self.user = None
+        self.date_created = timezone.now()
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_capture.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _current_capture.reset(self._token)
+
+    def add(self, obj, using):
+        """ keep the field values of ``obj``, deferred fields are loaded when the revision is written """
+        if obj.pk is None:
+            return
+        model = obj.__class__
+        deferred = obj.get_deferred_fields()
+        field_names = [f.attname for f in model._meta.concrete_fields if f.attname not in deferred]
+        key = (model, force_str(obj.pk), using)
+        self.objects.pop(key, None)
+        self.objects[key] = (field_names, [getattr(obj, attname) for attname in field_names])
+
+    def get_objects(self):
+        """ model instances with the field values they had when they were saved """
+        for (model, object_id, using), (field_names, values) in self.objects.items():
+            yield model.from_db(using, field_names, values)
+
+
+def _capture_saved_object(sender, instance, using, **kwargs):
+    capture = _current_capture.get()
+    if capture is not None and reversion.is_registered(sender):
+        capture.add(instance, using)
+
+
+def _capture_m2m_changed(sender, instance, action, using, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    capture = _current_capture.get()
+    if capture is not None and reversion.is_registered(instance.__class__):
+        capture.add(instance, using)
+
+
+post_save.connect(_capture_saved_object, dispatch_uid='revision_capture_post_save')
+m2m_changed.connect(_capture_m2m_changed, dispatch_uid='revision_capture_m2m_changed')
+
+
+def write_revisions(captures, using=None):
+    """
+    save one revision per capture through the revision api of reversion, which serializes the objects and
+    follows their relations. objects deleted since they were captured are skipped by reversion.
+    """
+    using = using or getattr(settings, 'REVISION_DB', None) or 'default'
+    with transaction.atomic(using=using):
+        for capture in captures:
+            if not capture.objects:
+                continue
+            with reversion.create_revision(using=using, atomic=False):
+                reversion.set_user(capture.user)
+                reversion.set_date_created(capture.date_created)
+                for obj in capture.get_objects():
+                    reversion.add_to_revision(obj, model_db=obj._state.db)
+
+
+revision_writer = BatchWriter(
+    'revision-writer', write_revisions,
+    batch_size=getattr(settings, 'REVISION_WRITER_BATCH_SIZE', 100),
+    flush_interval=getattr(settings, 'REVISION_WRITER_FLUSH_INTERVAL', 1.0),
+    max_queue_size=getattr(settings, 'REVISION_WRITER_QUEUE_SIZE', 10000),
+)
@@ -0,0 +1,278 @@
+import functools
+import re
+import traceback
+
+from django.conf import settings
+from django.db import DatabaseError, connections, models, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_save
+from django_multitenant.utils import get_current_tenant
+from rest_framework.filters import SearchFilter
+
+print = functools.partial(print, flush=True)
+
+SEARCH_RANK = 'search_rank'
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def get_indexed_fields(model):
+    """ fields of ``model`` kept in the search index (``SEARCH_INDEXES`` setting), or None """
+    return getattr(settings, 'SEARCH_INDEXES', {}).get(model._meta.label)
+
+
+def get_tenant_attname(model):
+    tenant_id = getattr(model, 'tenant_id', None)
+    if not tenant_id:
+        return None
+    for field in model._meta.concrete_fields:
+        if tenant_id in (field.name, field.attname):
+            return field.attname
+    return None
+
+
+def build_document(values):
+    return ' '.join(str(value) for value in values if value not in (None, ''))
+
+
+class BaseSearchBackend(object):
+    """
+    Search index of a database, one index table per model keyed by the model pk.
+    every row has the searchable text of the object and its tenant value, searches are scoped to the
+    current tenant and annotated with ``search_rank``.
+    """
+    vendor = None
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.quote = connection.ops.quote_name
+
+    def get_table(self, model):
+        return '{}_search'.format(model._meta.db_table)
+
+    def _execute(self, sql, params=None, many=False):
+        with self.connection.cursor() as cursor:
+            if many:
+                cursor.executemany(sql, params)
+            else:
+                cursor.execute(sql, params)
+
+    def create_table(self, model):
+        raise NotImplementedError
+
+    def drop_table(self, model):
+        self._execute('DROP TABLE IF EXISTS {}'.format(self.quote(self.get_table(model))))
+
+    def get_upsert_sql(self, model):
+        """ sql taking parameters returned by ``get_upsert_params`` """
+        raise NotImplementedError
+
+    def get_upsert_params(self, pk, tenant, text):
+        return [pk, tenant, text]
+
+    def delete_object(self, model, pk):
+        raise NotImplementedError
+
+    def clear(self, model):
+        self._execute('DELETE FROM {}'.format(self.quote(self.get_table(model))))
+
+    def index_object(self, instance):
+        model = instance.__class__
+        tenant_attname = get_tenant_attname(model)
+        text = build_document(getattr(instance, f) for f in get_indexed_fields(model))
+        tenant = getattr(instance, tenant_attname) if tenant_attname else None
+        self._execute(self.get_upsert_sql(model), self.get_upsert_params(instance.pk, tenant, text))
+
+    def rebuild(self, model, batch_size=1000):
+        """ reindex all objects of ``model``, return number of indexed objects """
+        tenant_attname = get_tenant_attname(model)
+        fields = list(get_indexed_fields(model))
+        rows = model._base_manager.using(self.connection.alias).order_by().values_list(
+            'pk', tenant_attname or 'pk', *fields)
+        sql = self.get_upsert_sql(model)
+        batch = []
+        count = 0
+        # in one transaction, searches see the old index until the new one is complete
+        with transaction.atomic(using=self.connection.alias):
+            self.clear(model)
+            for row in rows.iterator(chunk_size=batch_size):
+                batch.append(self.get_upsert_params(row[0], row[1] if tenant_attname else None,
+                                                    build_document(row[2:])))
+                if len(batch) >= batch_size:
+                    self._execute(sql, batch, many=True)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                self._execute(sql, batch, many=True)
+                count += len(batch)
+        return count
+
+    def get_search_sql(self, model, terms):
+        """ return (sql selecting matching pks, params, sql of rank of the outer row, params) or None """
+        raise NotImplementedError
+
+    def search(self, queryset, terms, tenant=None):
+        model = queryset.model
+        search_sql = self.get_search_sql(model, terms)
+        if search_sql is None:
+            return queryset.none()
+        match_sql, match_params, rank_sql, rank_params = search_sql
+        if tenant is not None:
+            match_sql += ' AND tenant = %s'
+            match_params = match_params + [tenant]
+        return queryset.filter(pk__in=RawSQL(match_sql, match_params)).annotate(
+            **{SEARCH_RANK: RawSQL(rank_sql, rank_params, output_field=models.FloatField())}
+        )
+
+    def _outer_pk(self, model):
+        return '{}.{}'.format(self.quote(model._meta.db_table), self.quote(model._meta.pk.column))
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    """ FTS5 virtual table, rows are matched by prefix of every search term and ranked by bm25 """
+    vendor = 'sqlite'
+
+    def create_table(self, model):
+        self._execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(content, tenant UNINDEXED, "
+            "tokenize='unicode61 remove_diacritics 2')".format(self.quote(self.get_table(model)))
+        )
+
+    def get_upsert_sql(self, model):
+        return 'INSERT OR REPLACE INTO {} (rowid, tenant, content) VALUES (%s, %s, %s)'.format(
+            self.quote(self.get_table(model)))
+
+    def delete_object(self, model, pk):
+        self._execute('DELETE FROM {} WHERE rowid = %s'.format(self.quote(self.get_table(model))), [pk])
+
+    def get_search_sql(self, model, terms):
+        tokens = _TOKEN_RE.findall(terms)
+        if not tokens:
+            return None
+        query = ' '.join('"{}"*'.format(token.replace('"', '""')) for token in tokens)
+        table = self.quote(self.get_table(model))
+        return (
+            'SELECT rowid FROM {0} WHERE {0} MATCH %s'.format(table), [query],
+            '(SELECT -rank FROM {0} WHERE {0} MATCH %s AND rowid = {1})'.format(table, self._outer_pk(model)), [query],
+        )
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    tsvector table with a gin index for prefix matching of words and a trigram index on the text
+    for substring matching (i.e: part of a phone number). needs the pg_trgm extension.
+    """
+    vendor = 'postgresql'
+
+    def create_table(self, model):
+        table = self.get_table(model)
+        self._execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS {} (object_id bigint PRIMARY KEY, tenant bigint NULL, '
+            'content text NOT NULL, document tsvector NOT NULL)'.format(self.quote(table))
+        )
+        self._execute('CREATE INDEX IF NOT EXISTS {} ON {} USING gin (document)'.format(
+            self.quote(table + '_document'), self.quote(table)))
+        self._execute('CREATE INDEX IF NOT EXISTS {} ON {} USING gin (content gin_trgm_ops)'.format(
+            self.quote(table + '_content_trgm'), self.quote(table)))
+        self._execute('CREATE INDEX IF NOT EXISTS {} ON {} (tenant)'.format(
+            self.quote(table + '_tenant'), self.quote(table)))
+
+    def get_upsert_sql(self, model):
+        return (
+            "INSERT INTO {} (object_id, tenant, content, document) "
+            "VALUES (%s, %s, %s, to_tsvector('simple', %s)) "
+            "ON CONFLICT (object_id) DO UPDATE SET "
+            "tenant = EXCLUDED.tenant, content = EXCLUDED.content, document = EXCLUDED.document"
+        ).format(self.quote(self.get_table(model)))
+
+    def get_upsert_params(self, pk, tenant, text):
+        return [pk, tenant, text, text]
+
+    def delete_object(self, model, pk):
+        self._execute('DELETE FROM {} WHERE object_id = %s'.format(self.quote(self.get_table(model))), [pk])
+
+    def get_search_sql(self, model, terms):
+        tokens = _TOKEN_RE.findall(terms)
+        if not tokens:
+            return None
+        query = ' & '.join('{}:*'.format(token) for token in tokens)
+        like = '%{}%'.format(terms.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        table = self.quote(self.get_table(model))
+        return (
+            "SELECT object_id FROM {} WHERE (document @@ to_tsquery('simple', %s) OR content ILIKE %s)".format(table),
+            [query, like],
+            "(SELECT ts_rank(document, to_tsquery('simple', %s)) + similarity(content, %s) "
+            "FROM {} WHERE object_id = {})".format(table, self._outer_pk(model)),
+            [query, terms],
+        )
+
+
+SEARCH_BACKENDS = {
+    backend.vendor: backend for backend in (SqliteSearchBackend, PostgresSearchBackend)
+}
+
+
+def get_search_backend(model, using='default'):
+    """ search backend of ``model`` on database ``using``, None if the model isn't indexed there """
+    if not get_indexed_fields(model) or not isinstance(model._meta.pk, (models.AutoField, models.IntegerField)):
+        return None
+    connection = connections[using]
+    backend_class = SEARCH_BACKENDS.get(connection.vendor)
+    return backend_class(connection) if backend_class else None
+
+
+class FullTextSearchFilter(SearchFilter):
+    """
+    SearchFilter using the search index of the model (``SEARCH_INDEXES`` setting) when the database has a
+    search backend, results are ranked unless an ordering is requested. models without an index and other
+    databases fall back to ``icontains`` lookups of ``search_fields``.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        search_fields = self.get_search_fields(view, request)
+        search_terms = self.get_search_terms(request)
+        if not search_fields or not search_terms:
+            return queryset
+        backend = get_search_backend(queryset.model, queryset.db)
+        if backend is None:
+            return super(FullTextSearchFilter, self).filter_queryset(request, queryset, view)
+        tenant = get_current_tenant()
+        return backend.search(queryset, ' '.join(search_terms), tenant.pk if tenant is not None else None)
+
+
+def _update_search_index(sender, instance, using, **kwargs):
+    backend = get_search_backend(sender, using)
+    if backend is None:
+        return
+    try:
+        # a savepoint, a failed index update must not break the transaction of the save
+        with transaction.atomic(using=using):
+            backend.index_object(instance)
+    except DatabaseError:
+        # i.e: the model was added to SEARCH_INDEXES after the migrations creating index tables
+        try:
+            with transaction.atomic(using=using):
+                backend.create_table(sender)
+                backend.index_object(instance)
+        except DatabaseError:
+            traceback.print_exc()
+            print('search index of {} {} is not updated'.format(sender._meta.label, instance.pk))
+
+
+def _delete_from_search_index(sender, instance, using, **kwargs):
+    backend = get_search_backend(sender, using)
+    if backend is None:
+        return
+    try:
+        with transaction.atomic(using=using):
+            backend.delete_object(sender, instance.pk)
+    except DatabaseError:
+        traceback.print_exc()
+        print('search index of {} {} is not updated'.format(sender._meta.label, instance.pk))
+
+
+def connect_search_signals():
+    """ keep indexes up to date on save and delete, bulk updates need ``manage.py rebuild_search_index`` """
+    for label in getattr(settings, 'SEARCH_INDEXES', {}):
+        post_save.connect(_update_search_index, sender=label, dispatch_uid='search_index_save_' + label)
+        post_delete.connect(_delete_from_search_index, sender=label, dispatch_uid='search_index_delete_' + label)
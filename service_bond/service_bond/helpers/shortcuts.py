@@ -1,3 +1,5 @@
+import os
+import threading
 import time
 
 from django.conf import settings
@@ -5,11 +7,30 @@ from django.core import signing
 from django.core.signing import Signer
 from django.http import Http404
 from django.utils import baseconv
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client as TwilioRestClient
 
+_twilio_clients = {}
+_twilio_clients_lock = threading.Lock()
 
-def get_twilio_client():
-    return TwilioRestClient(settings.SENDSMS_TWILIO_ACCOUNT_SID, settings.SENDSMS_TWILIO_AUTH_TOKEN)
+
+def get_twilio_client(account_sid=None, auth_token=None):
+    """ return the twilio client of this process, it keeps its http connections open between calls """
+    account_sid = account_sid or settings.SENDSMS_TWILIO_ACCOUNT_SID
+    auth_token = auth_token or settings.SENDSMS_TWILIO_AUTH_TOKEN
+    key = (os.getpid(), account_sid, auth_token)
+    client = _twilio_clients.get(key)
+    if client is None:
+        with _twilio_clients_lock:
+            client = _twilio_clients.get(key)
+            if client is None:
+                http_client = TwilioHttpClient(pool_connections=True)
+                pool_size = getattr(settings, 'SMS_DISPATCH_WORKERS', 16)
+                http_client.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+                client = TwilioRestClient(account_sid, auth_token, http_client=http_client)
+                _twilio_clients[key] = client
+    return client
 
 
 def unsign(s, salt=None, max_age=None, abort=True):
@@ -0,0 +1,206 @@
+import collections
+import concurrent.futures
+import functools
+import os
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+from sendsms import api
+from twilio.base.exceptions import TwilioRestException
+
+from service_bond.helpers.shortcuts import get_twilio_client
+
+print = functools.partial(print, flush=True)
+
+SmsResult = collections.namedtuple('SmsResult', ['to', 'ok', 'sid', 'error'])
+
+
+class TwilioTransport(object):
+    """ send messages with the pooled twilio client of this process """
+
+    def __init__(self, account_sid=None, auth_token=None):
+        self.account_sid = account_sid or settings.SENDSMS_TWILIO_ACCOUNT_SID
+        self.auth_token = auth_token or settings.SENDSMS_TWILIO_AUTH_TOKEN
+
+    @property
+    def account(self):
+        return 'twilio:{}'.format(self.account_sid)
+
+    def send(self, to, message, from_):
+        client = get_twilio_client(self.account_sid, self.auth_token)
+        return client.messages.create(to=to, from_=from_, body=message).sid
+
+    def is_retryable(self, error):
+        return isinstance(error, TwilioRestException) and (error.status == 429 or error.status >= 500)
+
+
+class SendsmsTransport(object):
+    """ send messages with the configured django-sendsms backend, as send_sms does """
+    account = 'sendsms'
+
+    def send(self, to, message, from_):
+        api.send_sms(body=message, from_phone=from_, to=[to], fail_silently=False)
+        return None
+
+    def is_retryable(self, error):
+        return False
+
+
+class FakeTransport(object):
+    """
+    keep messages in ``outbox`` instead of sending them, for tests and local development.
+    messages to numbers in ``failing`` raise an error.
+    """
+    account = 'fake'
+
+    def __init__(self, failing=(), delay=0):
+        self.failing = set(failing)
+        self.delay = delay
+        self.outbox = []
+        self._lock = threading.Lock()
+
+    def send(self, to, message, from_):
+        if self.delay:
+            time.sleep(self.delay)
+        if to in self.failing:
+            raise Exception('fake transport: sending to {} failed'.format(to))
+        with self._lock:
+            self.outbox.append({'to': to, 'from': from_, 'body': message})
+            return 'fake-{}'.format(len(self.outbox))
+
+    def is_retryable(self, error):
+        return False
+
+
+class RateLimiter(object):
+    """ token bucket, ``acquire`` blocks until a token is available. ``rate`` is tokens per second """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(account, rate, burst=None):
+    """ rate limiters are shared per account by all dispatchers of a process """
+    key = (os.getpid(), account)
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(rate, burst)
+        return _limiters[key]
+
+
+class SmsDispatcher(object):
+    """
+    Send one message to many recipients.
+
+    messages are sent concurrently by a bounded thread pool of ``SMS_DISPATCH_WORKERS`` threads, at most
+    ``SMS_DISPATCH_RATE`` messages per second per account of the transport (per process). failed messages are
+    retried ``SMS_DISPATCH_RETRIES`` times if the transport considers the error temporary. ``send`` blocks and
+    returns an SmsResult per recipient, ``dispatch`` sends in background and returns a future of the results.
+    the transport is ``SMS_DISPATCH_TRANSPORT``, use FakeTransport in tests.
+    """
+
+    def __init__(self, transport=None, workers=None, rate=None, burst=None, retries=None, retry_delay=1.0):
+        self._transport = transport
+        self.workers = workers or getattr(settings, 'SMS_DISPATCH_WORKERS', 16)
+        self.rate = rate if rate is not None else getattr(settings, 'SMS_DISPATCH_RATE', 50)
+        self.burst = burst or getattr(settings, 'SMS_DISPATCH_BURST', None)
+        self.retries = retries if retries is not None else getattr(settings, 'SMS_DISPATCH_RETRIES', 2)
+        self.retry_delay = retry_delay
+        self._senders = None
+        self._jobs = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            path = getattr(settings, 'SMS_DISPATCH_TRANSPORT', 'service_bond.helpers.sms.TwilioTransport')
+            self._transport = import_string(path)()
+        return self._transport
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # threads don't survive a fork, a forked worker starts its own pools
+                    self._senders = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='sms-send')
+                    self._jobs = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='sms-dispatch')
+                    self._pid = pid
+
+    def _send_one(self, limiter, to, message, from_):
+        for attempt in range(self.retries + 1):
+            limiter.acquire()
+            try:
+                return SmsResult(to, True, self.transport.send(to, message, from_), None)
+            except Exception as e:
+                if attempt < self.retries and self.transport.is_retryable(e):
+                    time.sleep(self.retry_delay * 2 ** attempt)
+                    continue
+                return SmsResult(to, False, None, str(e))
+
+    def send(self, message, recipients, from_=None):
+        """ send ``message`` to every recipient, return their results in the order of ``recipients`` """
+        from_ = from_ or settings.SMS_DEFAULT_FROM_PHONE
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        recipients = list(dict.fromkeys(recipients))
+        self._ensure_started()
+        limiter = get_rate_limiter(self.transport.account, self.rate, self.burst)
+        futures = [self._senders.submit(self._send_one, limiter, to, message, from_) for to in recipients]
+        return [future.result() for future in futures]
+
+    def _run(self, message, recipients, from_, callback):
+        try:
+            results = self.send(message, recipients, from_)
+            failed = sum(1 for result in results if not result.ok)
+            if failed:
+                print('sms dispatch: {} of {} messages failed'.format(failed, len(results)))
+            if callback is not None:
+                close_old_connections()
+                callback(results)
+            return results
+        except Exception:
+            traceback.print_exc()
+            raise
+        finally:
+            close_old_connections()
+
+    def dispatch(self, message, recipients, from_=None, callback=None):
+        """
+        send ``message`` to every recipient in background, ``callback`` is called with the results.
+        returns a future of the results.
+        """
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        self._ensure_started()
+        return self._jobs.submit(self._run, message, list(recipients), from_, callback)
+
+
+sms_dispatcher = SmsDispatcher()
@@ -0,0 +1,220 @@
+import functools
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F, FileField
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
+from storages.backends.s3boto3 import S3Boto3Storage
+
+EXTENSION_RE = re.compile(r'^\.[a-z0-9]{1,10}$')
+
+
+class ContentAddressedStorageMixin(object):
+    """
+    Store files under the sha256 of their content, as ``<prefix>/ab/cd/<sha256><ext>``.
+
+    the content is hashed while it is copied to a temporary file, then the temporary file is committed under its
+    hash name (``_commit``). a file which is already stored is not written again, every save adds a reference to
+    it in ``StoredFile`` and ``release`` (or ``delete``) removes the file after commit when its last reference is
+    released. references of file fields are released when their file is replaced or their object is deleted (see
+    ``connect_storage_signals``). the name given to ``save`` is used for its extension only.
+    """
+    prefix = None
+    chunk_size = 64 * 1024
+
+    def get_prefix(self):
+        if self.prefix is None:
+            return getattr(settings, 'CONTENT_ADDRESSED_STORAGE_PREFIX', 'cas')
+        return self.prefix
+
+    @property
+    def model(self):
+        return apps.get_model('administration', 'StoredFile')
+
+    def get_temp_dir(self):
+        return getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None)
+
+    def get_available_name(self, name, max_length=None):
+        # the stored name depends on the content only, see _save
+        return name
+
+    def get_content_name(self, digest, name):
+        extension = os.path.splitext(name)[1].lower()
+        if not EXTENSION_RE.match(extension):
+            extension = ''
+        return posixpath.join(self.get_prefix(), digest[:2], digest[2:4], digest + extension)
+
+    def _spool(self, content):
+        """ copy ``content`` to a temporary file, return (temporary file path, sha256 hex digest, size) """
+        digest, size = hashlib.sha256(), 0
+        tmp = tempfile.NamedTemporaryFile(prefix='.upload-', dir=self.get_temp_dir(), delete=False)
+        try:
+            for chunk in content.chunks(self.chunk_size):
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                digest.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+            tmp.close()
+        except Exception:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+        return tmp.name, digest.hexdigest(), size
+
+    def _commit(self, tmp_path, name):
+        """ store the temporary file under ``name``, it must replace an existing file atomically """
+        raise NotImplementedError('subclasses of ContentAddressedStorageMixin must provide a _commit() method')
+
+    def _save(self, name, content):
+        tmp_path, digest, size = self._spool(content)
+        name = self.get_content_name(digest, name)
+        try:
+            with transaction.atomic():
+                # the row lock orders this save against a delete of the last reference of the same file
+                stored, created = self.model.objects.select_for_update().get_or_create(
+                    name=name, defaults={'size': size, 'references': 1})
+                if not created:
+                    self.model.objects.filter(name=name).update(references=F('references') + 1)
+                if created or not self.exists(name):
+                    self._commit(tmp_path, name)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return name
+
+    def save_named(self, name, content):
+        """ save ``content`` under ``name`` itself, replacing an existing file. it is not reference counted """
+        tmp_path = self._spool(content)[0]
+        try:
+            self._commit(tmp_path, name)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return name
+
+    def release(self, name):
+        """
+        remove a reference to ``name``, return False if the file is not reference counted by this storage.
+        the file is deleted after commit when it was the last reference, a rollback keeps the file and its count.
+        """
+        with transaction.atomic():
+            # the row lock orders this against a save of the same content
+            stored = self.model.objects.select_for_update().filter(name=name).first()
+            if stored is None:
+                return False
+            if stored.references > 0:
+                self.model.objects.filter(name=name).update(references=F('references') - 1)
+            if stored.references <= 1:
+                transaction.on_commit(functools.partial(self._delete_unreferenced, name))
+        return True
+
+    def _delete_unreferenced(self, name):
+        with transaction.atomic():
+            stored = self.model.objects.select_for_update().filter(name=name).first()
+            # a save of the same content between the commit and now added a reference again
+            if stored is not None and stored.references == 0:
+                super(ContentAddressedStorageMixin, self).delete(name)
+                stored.delete()
+
+    def delete(self, name):
+        if not self.release(name):
+            # not saved by this storage (i.e: uploaded before it was used)
+            super(ContentAddressedStorageMixin, self).delete(name)
+
+
+_FIELD_NAMES = '_content_addressed_names'
+_FIELD_UPLOADS = '_content_addressed_uploads'
+
+
+def get_content_addressed_fields(model):
+    return [field for field in model._meta.concrete_fields
+            if isinstance(field, FileField) and isinstance(field.storage, ContentAddressedStorageMixin)]
+
+
+def _remember_names(sender, instance, **kwargs):
+    # names as loaded, deferred fields are not known and their files keep their reference
+    setattr(instance, _FIELD_NAMES, {field.attname: instance.__dict__[field.attname]
+                                     for field in get_content_addressed_fields(sender)
+                                     if field.attname in instance.__dict__})
+
+
+def _remember_uploads(sender, instance, raw=False, **kwargs):
+    # a file assigned to the field is saved by this save, it adds a reference even if its content is not new
+    setattr(instance, _FIELD_UPLOADS, {
+        field.attname for field in get_content_addressed_fields(sender)
+        if getattr(instance, field.attname) and not getattr(instance, field.attname)._committed
+    })
+
+
+def _release_replaced_files(sender, instance, raw=False, **kwargs):
+    names = getattr(instance, _FIELD_NAMES, {})
+    uploads = getattr(instance, _FIELD_UPLOADS, set())
+    for field in get_content_addressed_fields(sender):
+        old_name = names.get(field.attname)
+        new_name = getattr(instance, field.attname).name or None
+        if old_name and (old_name != new_name or field.attname in uploads):
+            field.storage.release(old_name)
+        if field.attname in names or field.attname in uploads:
+            names[field.attname] = new_name
+    setattr(instance, _FIELD_NAMES, names)
+    setattr(instance, _FIELD_UPLOADS, set())
+
+
+def _release_deleted_files(sender, instance, **kwargs):
+    for field in get_content_addressed_fields(sender):
+        name = getattr(instance, field.attname).name
+        if name:
+            field.storage.release(name)
+
+
+def connect_storage_signals():
+    """ release references of files of content addressed storages when they are replaced or deleted """
+    for model in apps.get_models():
+        if not get_content_addressed_fields(model):
+            continue
+        label = model._meta.label
+        post_init.connect(_remember_names, sender=model, dispatch_uid='storage_post_init_' + label)
+        pre_save.connect(_remember_uploads, sender=model, dispatch_uid='storage_pre_save_' + label)
+        post_save.connect(_release_replaced_files, sender=model, dispatch_uid='storage_post_save_' + label)
+        post_delete.connect(_release_deleted_files, sender=model, dispatch_uid='storage_post_delete_' + label)
+
+
+class ContentAddressedFileSystemStorage(ContentAddressedStorageMixin, FileSystemStorage):
+    """ content addressed storage on the local file system, files are committed with an atomic rename """
+
+    def get_temp_dir(self):
+        # a rename is atomic only inside one file system
+        directory = os.path.join(self.location, '.tmp')
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def _commit(self, tmp_path, name):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        if self.directory_permissions_mode is not None:
+            old_umask = os.umask(0)
+            try:
+                os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory, exist_ok=True)
+        os.chmod(tmp_path, self.file_permissions_mode if self.file_permissions_mode is not None else 0o644)
+        os.replace(tmp_path, full_path)
+
+
+class ContentAddressedS3Storage(ContentAddressedStorageMixin, S3Boto3Storage):
+    """ content addressed storage on s3, a put of an object is atomic and a stored object is not uploaded again """
+
+    def _commit(self, tmp_path, name):
+        with open(tmp_path, 'rb') as f:
+            S3Boto3Storage._save(self, name, File(f, name=posixpath.basename(name)))
@@ -0,0 +1,129 @@
+import contextvars
+import copy
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_save
+from django_multitenant import utils as multitenant_utils
+
+from service_bond.helpers.cache import LRUCache
+
+
+class ContextLocal(object):
+    """
+    Attribute storage like ``threading.local``, but values live in a context variable.
+    every thread and every asyncio task sees its own values, and ``sync_to_async`` passes them to sync code.
+    """
+
+    def __init__(self, name):
+        object.__setattr__(self, '_values', contextvars.ContextVar(name, default=None))
+
+    def __getattr__(self, name):
+        values = self._values.get()
+        if values is None or name not in values:
+            raise AttributeError(name)
+        return values[name]
+
+    def __setattr__(self, name, value):
+        # copy on write, so a context never modifies the dict seen by the context it was copied from
+        values = dict(self._values.get() or {})
+        values[name] = value
+        self._values.set(values)
+
+    def __delattr__(self, name):
+        values = dict(self._values.get() or {})
+        if name not in values:
+            raise AttributeError(name)
+        del values[name]
+        self._values.set(values)
+
+
+def install_context_tenant_storage():
+    """
+    make ``set_current_tenant`` / ``get_current_tenant`` of django_multitenant context-local instead of thread-local,
+    so concurrent requests of one event loop don't see each other's tenant.
+    """
+    if not isinstance(multitenant_utils._thread_locals, ContextLocal):
+        multitenant_utils._thread_locals = ContextLocal('current_tenant')
+
+
+install_context_tenant_storage()
+
+
+class TenantRegistry(object):
+    """
+    In-process registry of shops used to resolve the current tenant without a query per request.
+    a shop is stored as the raw values of its row, every lookup builds a fresh ``Shop`` instance from them,
+    so a request can never modify the object seen by another one.
+    unknown ids are stored as negative entries with a shorter ttl.
+    """
+    NOT_FOUND = object()
+
+    def __init__(self, maxsize=None, ttl=None, negative_ttl=None):
+        self.ttl = ttl or getattr(settings, 'TENANT_REGISTRY_TTL', 300)
+        self.negative_ttl = negative_ttl or getattr(settings, 'TENANT_REGISTRY_NEGATIVE_TTL', 30)
+        self._records = LRUCache(maxsize or getattr(settings, 'TENANT_REGISTRY_SIZE', 1024), ttl=self.ttl)
+
+    @property
+    def model(self):
+        return apps.get_model('administration', 'Shop')
+
+    def _normalize_id(self, shop_id):
+        try:
+            return int(shop_id)
+        except (ValueError, TypeError):
+            return None
+
+    def _load(self, shop_id):
+        field_names = tuple(f.attname for f in self.model._meta.concrete_fields)
+        row = self.model.all_objects.filter(id=shop_id).values_list(*field_names).first()
+        if row is None:
+            return self.NOT_FOUND
+        return field_names, row
+
+    def get(self, shop_id):
+        """ return a ``Shop`` instance for ``shop_id`` or None if there is no such shop """
+        shop_id = self._normalize_id(shop_id)
+        if shop_id is None:
+            return None
+        record = self._records.get(shop_id, LRUCache.MISSING)
+        if record is LRUCache.MISSING:
+            record = self._load(shop_id)
+            ttl = self.negative_ttl if record is self.NOT_FOUND else None
+            self._records.set(shop_id, record, ttl=ttl)
+        return self._to_shop(record)
+
+    def get_cached(self, shop_id):
+        """ like ``get``, but return ``LRUCache.MISSING`` instead of querying a shop which is not cached """
+        shop_id = self._normalize_id(shop_id)
+        if shop_id is None:
+            return None
+        record = self._records.get(shop_id, LRUCache.MISSING)
+        if record is LRUCache.MISSING:
+            return record
+        return self._to_shop(record)
+
+    def _to_shop(self, record):
+        if record is self.NOT_FOUND:
+            return None
+        field_names, values = record
+        # json fields hold mutable objects, the cached row must not be shared with the new instance
+        return self.model.from_db(DEFAULT_DB_ALIAS, field_names, copy.deepcopy(values))
+
+    def invalidate(self, shop_id):
+        self._records.pop(self._normalize_id(shop_id))
+
+    def clear(self):
+        self._records.clear()
+
+
+tenant_registry = TenantRegistry()
+
+
+def _invalidate_tenant(sender, instance, **kwargs):
+    tenant_registry.invalidate(instance.pk)
+
+
+post_save.connect(_invalidate_tenant, sender='administration.Shop', dispatch_uid='tenant_registry_post_save')
+post_delete.connect(_invalidate_tenant, sender='administration.Shop', dispatch_uid='tenant_registry_post_delete')
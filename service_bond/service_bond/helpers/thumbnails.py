@@ -0,0 +1,279 @@
+import concurrent.futures
+import concurrent.futures.process
+import functools
+import io
+import json
+import multiprocessing
+import os
+import threading
+import traceback
+
+from PIL import Image
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_save
+
+from service_bond.helpers.cache import LRUCache
+
+print = functools.partial(print, flush=True)
+
+IMAGE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.gif': 'GIF', '.png': 'PNG'}
+
+
+def get_image_format(name):
+    extension = os.path.splitext(name)[1].lower()
+    if extension not in IMAGE_FORMATS:
+        raise Exception('Not supported format "{}"'.format(extension))
+    return IMAGE_FORMATS[extension]
+
+
+def get_thumbnail_size(size, scale):
+    """ size of a thumbnail whose shorter side is ``scale``, None if the image is not bigger than that """
+    x, y = size
+    if x <= scale or y <= scale:
+        return None
+    if x > y:
+        return int(max(x / max(y / scale, 1), 1)), scale
+    if x < y:
+        return scale, int(max(y / max(x / scale, 1), 1))
+    return scale, scale
+
+
+def open_image(fp, scale):
+    """
+    open and decode an image which is used to make thumbnails of ``scale`` or smaller.
+    jpegs are decoded in draft mode, at the smallest 1/2, 1/4 or 1/8 scale which is still large enough.
+    """
+    image = Image.open(fp)
+    if image.format == 'JPEG':
+        size = get_thumbnail_size(image.size, scale)
+        if size:
+            image.draft(image.mode, size)
+    image.load()
+    return image
+
+
+def render_thumbnails(data, name, scales):
+    """
+    return {scale: encoded thumbnail} of an image from one decode, largest thumbnails are made first and
+    every smaller one is made from the previous. it runs in worker processes, so it must not use django.
+    """
+    image_format = get_image_format(name)
+    image = open_image(io.BytesIO(data), max(scales))
+    result = {}
+    for scale in sorted(scales, reverse=True):
+        size = get_thumbnail_size(image.size, scale)
+        if size:
+            image.thumbnail(size, Image.ANTIALIAS)
+        output = io.BytesIO()
+        image.save(output, image_format)
+        result[scale] = output.getvalue()
+    return result
+
+
+class ThumbnailPipeline(object):
+    """
+    Make thumbnails of uploaded images in a process pool, out of the request.
+
+    every size of ``THUMBNAIL_SIZES`` is made from one decode of the original and saved next to it as
+    ``<name>_size<scale>.<ext>`` (same names as resize_photo). when all of them are saved a manifest
+    ``<name>_thumbs.json`` is written, it marks the thumbnails as ready. until then ``url`` returns the
+    original image url. ``submit`` only hands the name over: the original is read and the thumbnails are saved by
+    ``THUMBNAIL_IO_WORKERS`` threads, they are rendered by ``THUMBNAIL_WORKERS`` processes. with
+    ``THUMBNAIL_WORKERS = 0`` all of it is done in the calling thread.
+    """
+
+    def __init__(self, sizes=None, workers=None, io_workers=None):
+        self.sizes = sizes or getattr(settings, 'THUMBNAIL_SIZES', {'small': 100})
+        self.workers = workers if workers is not None else getattr(settings, 'THUMBNAIL_WORKERS', 2)
+        self.io_workers = io_workers or getattr(settings, 'THUMBNAIL_IO_WORKERS', 4)
+        self._executor = None
+        self._pid = None
+        self._io_executor = None
+        self._io_pid = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._manifests = LRUCache(maxsize=1024)
+
+    @property
+    def executor(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # spawned workers don't inherit threads and connections of the web worker
+                    self._executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+                    self._pid = pid
+        return self._executor
+
+    @property
+    def io_executor(self):
+        pid = os.getpid()
+        if self._io_pid != pid:
+            with self._lock:
+                if self._io_pid != pid:
+                    # threads don't survive a fork, a forked worker starts its own threads
+                    self._io_executor = concurrent.futures.ThreadPoolExecutor(
+                        self.io_workers, thread_name_prefix='thumbnails-io')
+                    self._io_pid = pid
+        return self._io_executor
+
+    def _reset_executor(self, executor):
+        """ drop a broken pool (i.e: a worker was killed), the next submit starts a new one """
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self._pid = None
+        executor.shutdown(wait=False)
+
+    @staticmethod
+    def variant_name(name, scale):
+        base, extension = os.path.splitext(name)
+        return '{}_size{}{}'.format(base, scale, extension.lower())
+
+    @staticmethod
+    def manifest_name(name):
+        return '{}_thumbs.json'.format(os.path.splitext(name)[0])
+
+    @property
+    def scales(self):
+        return sorted(set(self.sizes.values()))
+
+    def _get_manifest(self, storage, name):
+        manifest = self._manifests.get(name)
+        if manifest is None:
+            manifest_name = self.manifest_name(name)
+            if not storage.exists(manifest_name):
+                return None
+            with storage.open(manifest_name, 'rb') as f:
+                manifest = {int(k): v for k, v in json.loads(f.read().decode())['sizes'].items()}
+            # file names are unique per upload (or per content), a manifest never changes
+            self._manifests.set(name, manifest)
+        return manifest
+
+    def get_manifest(self, field):
+        """ return {scale: name} of ready thumbnails of an image field, or None """
+        return self._get_manifest(field.storage, field.name)
+
+    def is_ready(self, field):
+        return self.get_manifest(field) is not None
+
+    def url(self, field, size):
+        manifest = self.get_manifest(field)
+        scale = self.sizes[size]
+        if manifest is None or scale not in manifest:
+            return field.url
+        return field.storage.url(manifest[scale])
+
+    def submit(self, field):
+        """ make thumbnails of ``field`` in background, nothing is read from the storage in the calling thread """
+        name, storage = field.name, field.storage
+        with self._lock:
+            if name in self._pending:
+                return
+            self._pending.add(name)
+        try:
+            if not self.workers:
+                try:
+                    data = self._read(storage, name)
+                    if data is not None:
+                        self._save(storage, name, render_thumbnails(data, name, self.scales))
+                finally:
+                    self._discard(name)
+                return
+            self.io_executor.submit(self._start, storage, name)
+        except Exception:
+            self._discard(name)
+            raise
+
+    def submit_safely(self, field):
+        """ like submit, but errors are logged. it's called after commit, a failure must not fail the request """
+        try:
+            self.submit(field)
+        except Exception:
+            traceback.print_exc()
+            print('making thumbnails of {} failed'.format(field.name))
+
+    def _discard(self, name):
+        with self._lock:
+            self._pending.discard(name)
+
+    def _read(self, storage, name):
+        """ return the content of the original image, None if its thumbnails are ready """
+        if self._get_manifest(storage, name) is not None:
+            return None
+        with storage.open(name, 'rb') as f:
+            return f.read()
+
+    def _start(self, storage, name):
+        """ read the original and render its thumbnails in the process pool, it runs in an io thread """
+        try:
+            close_old_connections()
+            data = self._read(storage, name)
+            if data is None:
+                self._discard(name)
+                return
+            executor = self.executor
+            try:
+                future = executor.submit(render_thumbnails, data, name, self.scales)
+            except concurrent.futures.process.BrokenProcessPool:
+                self._reset_executor(executor)
+                executor = self.executor
+                future = executor.submit(render_thumbnails, data, name, self.scales)
+            future.add_done_callback(functools.partial(self._on_done, executor, storage, name))
+        except Exception:
+            self._discard(name)
+            traceback.print_exc()
+            print('making thumbnails of {} failed'.format(name))
+        finally:
+            close_old_connections()
+
+    def _on_done(self, executor, storage, name, future):
+        # it's called by the management thread of the process pool, which must not wait for the storage
+        try:
+            self.io_executor.submit(self._finish, executor, storage, name, future)
+        except Exception:
+            self._discard(name)
+            traceback.print_exc()
+            print('making thumbnails of {} failed'.format(name))
+
+    def _finish(self, executor, storage, name, future):
+        """ save rendered thumbnails, it runs in an io thread """
+        try:
+            close_old_connections()
+            self._save(storage, name, future.result())
+        except Exception as e:
+            if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                self._reset_executor(executor)
+            traceback.print_exc()
+            print('making thumbnails of {} failed'.format(name))
+        finally:
+            self._discard(name)
+            close_old_connections()
+
+    def _save(self, storage, name, thumbnails):
+        saved = {}
+        for scale, content in thumbnails.items():
+            saved[str(scale)] = storage.save(self.variant_name(name, scale), ContentFile(content))
+        # a content addressed storage would store the manifest under its own hash, it must keep its name
+        save_named = getattr(storage, 'save_named', storage.save)
+        save_named(self.manifest_name(name), ContentFile(json.dumps({'sizes': saved}).encode()))
+
+
+thumbnail_pipeline = ThumbnailPipeline()
+
+
+def _make_thumbnails(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    for field_name in getattr(settings, 'THUMBNAIL_FIELDS', {}).get(sender._meta.label, ()):
+        field = getattr(instance, field_name)
+        if field and field.name:
+            transaction.on_commit(functools.partial(thumbnail_pipeline.submit_safely, field))
+
+
+def connect_thumbnail_signals():
+    for label in getattr(settings, 'THUMBNAIL_FIELDS', {}):
+        post_save.connect(_make_thumbnails, sender=label, dispatch_uid='thumbnails_post_save_' + label)
@@ -1,13 +1,22 @@
 import ast
 import base64
+import binascii
+import concurrent.futures
+import copy
 import datetime
 import decimal
 import functools
+import hashlib
+import hmac
 import inspect
+import itertools
+import json
 import os
+import posixpath
 import random
 import re
 import string
+import threading
 import traceback
 import uuid
 from collections import OrderedDict
@@ -18,24 +27,32 @@ from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import Permission
 from django.contrib.auth.views import redirect_to_login
 from django.contrib.staticfiles.storage import ManifestFilesMixin
-from django.core.exceptions import PermissionDenied, RequestDataTooBig
+from django.contrib.staticfiles.utils import matches_patterns
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied, RequestDataTooBig
 from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
-from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile, UploadedFile
 from django.db import IntegrityError
-from django.db.models import ProtectedError
-from django.http import JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, ProtectedError, Q, QuerySet
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import OrderBy
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.utils import timezone
 from django_filters import OrderingFilter
 from django_filters.constants import EMPTY_VALUES
 from django_multitenant.utils import get_current_tenant
 from rest_framework import status, serializers, permissions
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, NotFound
 from rest_framework.pagination import PageNumberPagination, _positive_int
+from rest_framework.renderers import JSONRenderer
 from rest_framework.permissions import BasePermission, DjangoModelPermissions, IsAuthenticated
 from rest_framework.filters import OrderingFilter as OrderingFilterBackend
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from rest_framework_tracking.mixins import LoggingMixin
 from sendsms import api
 from django.urls import reverse
@@ -48,9 +65,117 @@ from django.contrib.auth.mixins import PermissionRequiredMixin as \
 from six import BytesIO
 from storages.backends.s3boto3 import S3Boto3Storage
 
+from service_bond.helpers.background import BatchWriter
+from service_bond.helpers.cache import LRUCache
+from service_bond.helpers.errors import error_report
+from service_bond.helpers.memberships import membership_cache
+from service_bond.helpers.permissions import PermissionCache
+from service_bond.helpers.search import SEARCH_RANK
+from service_bond.helpers.sms import sms_dispatcher
+from service_bond.helpers.thumbnails import get_image_format, get_thumbnail_size, open_image
+
 print = functools.partial(print, flush=True)
 
 
+def _convert_value(v):
+    if isinstance(v, datetime.datetime):
+        return v.isoformat() + 'Z'
+    elif isinstance(v, datetime.date):
+        return v.isoformat()
+    elif isinstance(v, decimal.Decimal):
+        return float(v)
+    return v
+
+
+def _convert_datetime(v):
+    return v.isoformat() + 'Z' if v is not None else None
+
+
+def _convert_date(v):
+    return v.isoformat() if v is not None else None
+
+
+def _convert_decimal(v):
+    return float(v) if v is not None else None
+
+
+def _get_field_converter(model, field_name):
+    try:
+        field = model._meta.get_field(field_name)
+    except Exception:
+        return _convert_value
+    internal_type = field.get_internal_type() if hasattr(field, 'get_internal_type') else None
+    if internal_type == 'DateTimeField':
+        return _convert_datetime
+    if internal_type == 'DateField':
+        return _convert_date
+    if internal_type == 'DecimalField':
+        return _convert_decimal
+    return _convert_value
+
+
+def _build_to_dict_plan(model, fields, mapped_fields, extra_fields, from_dict):
+    """
+    return a tuple of (field name, getter, converter) used to convert objects of ``model`` to dict.
+    the getter of a field of ``fields_map`` is None, it's bound to the function of the call by ``_bind_plan``.
+    """
+    if fields is None:
+        # rows of values() are keyed by attname (i.e: shop_id)
+        fields = [f.attname if from_dict else f.name for f in model._meta.fields]
+    plan = []
+    for field in list(fields) + list(extra_fields or []):
+        if field in mapped_fields:
+            if mapped_fields[field]:
+                plan.append((field, None, _convert_value))
+        elif from_dict:
+            getter = functools.partial(lambda name, row: row.get(name), field)
+            plan.append((field, getter, _get_field_converter(model, field)))
+        else:
+            getter = functools.partial(lambda name, obj: getattr(obj, name, None), field)
+            plan.append((field, getter, _get_field_converter(model, field)))
+    return tuple(plan)
+
+
+_to_dict_plans = LRUCache(maxsize=256)
+_arities = LRUCache(maxsize=1024)
+
+
+def _get_arity(func):
+    if not inspect.isfunction(func):
+        return len(inspect.signature(func).parameters)
+    # inline lambdas are new functions on every call, their code is the same
+    return _arities.get_or_set(func.__code__, lambda: len(inspect.signature(func).parameters))
+
+
+def _bind_plan(plan, fields_map):
+    if not fields_map:
+        return plan
+    bound = []
+    for field, getter, converter in plan:
+        if getter is None:
+            getter = fields_map[field]
+            if _get_arity(getter) != 1:
+                getter = functools.partial(lambda f, obj: f(), getter)
+        bound.append((field, getter, converter))
+    return bound
+
+
+def _get_to_dict_plan(model, fields, fields_map, extra_fields, from_dict=False):
+    fields_map = fields_map or {}
+    # plans are cached by field names only, functions of fields_map are bound on every call
+    mapped_fields = {field: func is not None for field, func in fields_map.items()}
+    try:
+        key = (model, tuple(fields) if fields is not None else None, tuple(sorted(mapped_fields.items())),
+               tuple(extra_fields or ()), from_dict)
+        hash(key)
+    except TypeError:
+        plan = _build_to_dict_plan(model, fields, mapped_fields, extra_fields, from_dict)
+    else:
+        plan = _to_dict_plans.get_or_set(
+            key, lambda: _build_to_dict_plan(model, fields, mapped_fields, extra_fields, from_dict))
+    return _bind_plan(plan, fields_map)
+
+
 def to_dict(obj, fields=None, fields_map=None, extra_fields=None):
     """
     convert a model object to a python dict.
@@ -65,40 +190,87 @@ def to_dict(obj, fields=None, fields_map=None, extra_fields=None):
     @type fields_map: dict
     @param extra_fields: add new or override existing fields
     """
-    data = {}
-    fields_map = fields_map or {}
+    plan = _get_to_dict_plan(obj.__class__, fields, fields_map, extra_fields)
+    return {field: converter(getter(obj)) for field, getter, converter in plan}
 
-    if fields is None:
-        fields = [f.name for f in obj.__class__._meta.fields]
-    fields.extend(extra_fields or [])
-    for field in fields:
-        if field in fields_map:
-            if fields_map[field] is None:
-                continue
-            func = fields_map.get(field)
-            if len(inspect.signature(func).parameters) == 1:
-                v = func(obj)
-            else:
-                v = func()
-        else:
-            v = getattr(obj, field, None)
-        if isinstance(v, datetime.datetime):
-            data[field] = v.isoformat() + 'Z'
-        elif isinstance(v, datetime.date):
-            data[field] = v.isoformat()
-        elif isinstance(v, decimal.Decimal):
-            data[field] = float(v)
-        else:
-            data[field] = v
 
-    return data
+def to_dict_many(rows, model=None, fields=None, fields_map=None, extra_fields=None):
+    """
+    convert many objects to a list of python dicts, same as calling to_dict for every object.
+    the conversion plan is built once for all rows.
+    @param rows: a queryset, a list of model objects or rows of a ``values()`` queryset
+    @param model: model of rows. it's required only when rows are dicts and not a queryset
+    """
+    if isinstance(rows, QuerySet):
+        model = model or rows.model
+        if rows._result_cache is None:
+            rows = rows.iterator(chunk_size=2000)
+    result = []
+    plan = None
+    for row in rows:
+        if plan is None:
+            from_dict = isinstance(row, dict)
+            plan = _get_to_dict_plan(model or row.__class__, fields, fields_map, extra_fields, from_dict=from_dict)
+        result.append({field: converter(getter(row)) for field, getter, converter in plan})
+    return result
+
+
+class _CursorJSONEncoder(DjangoJSONEncoder):
+    """ DjangoJSONEncoder cuts datetimes and times to milliseconds, cursor values must stay exact """
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(_CursorJSONEncoder, self).default(o)
+
+
+class _CursorSerializer(object):
+    """ signing serializer of keyset cursors, values may be dates, decimals, uuids, ... """
+
+    def dumps(self, obj):
+        return json.dumps(obj, cls=_CursorJSONEncoder, separators=(',', ':')).encode('latin-1')
+
+    def loads(self, data):
+        return json.loads(data.decode('latin-1'))
+
+
+def _get_lookup_value(obj, lookup):
+    for part in lookup.split(LOOKUP_SEP):
+        if obj is None:
+            return None
+        obj = getattr(obj, part, None)
+    return obj
 
 
 class CustomPagination(PageNumberPagination):
-    """ Custom Pagination to be used in rest api"""
+    """
+    Custom Pagination to be used in rest api
+
+    two modes are supported:
+    - page: page number based pagination (default)
+    - keyset: pages are selected by an opaque cursor holding the ordering values of the last row of a page,
+      so every page costs the same no matter how deep it is and no COUNT query is done.
+      it's selected by ``pagination_mode = 'keyset'`` in view, ``pagination=keyset`` query param, or
+      by passing a ``cursor`` query param. view ordering (including extra_ordering_fields) is used with
+      the pk as a tiebreaker. NULL values are ordered as the biggest values.
+    """
 
     BIG_PAGE_SIZE = 10000000
     page_size_query_param = 'page_size'
+    pagination_mode_query_param = 'pagination'
+    cursor_query_param = 'cursor'
+    MODE_PAGE = 'page'
+    MODE_KEYSET = 'keyset'
+    CURSOR_SALT = 'keyset-pagination'
+    invalid_cursor_message = 'Invalid cursor'
+
+    mode = MODE_PAGE
+
+    def get_pagination_mode(self, request, view=None):
+        if request.query_params.get(self.cursor_query_param):
+            return self.MODE_KEYSET
+        mode = request.query_params.get(self.pagination_mode_query_param) or getattr(view, 'pagination_mode', None)
+        return self.MODE_KEYSET if mode == self.MODE_KEYSET else self.MODE_PAGE
 
     def paginate_queryset(self, queryset, request, view=None):
         if view:
@@ -106,6 +278,13 @@ class CustomPagination(PageNumberPagination):
             if max_page_size is None:
                 max_page_size = settings.REST_FRAMEWORK.get('MAX_PAGE_SIZE_DEFAULT', 100)
             self.max_page_size = self.BIG_PAGE_SIZE if max_page_size == 0 else max_page_size
+        self.mode = self.get_pagination_mode(request, view)
+        if self.mode == self.MODE_KEYSET:
+            keyset_ordering = self.get_keyset_ordering(queryset)
+            if keyset_ordering is not None:
+                return self.paginate_keyset(queryset, request, keyset_ordering)
+            # ordering by expressions can't be paginated by keyset
+            self.mode = self.MODE_PAGE
         return super(CustomPagination, self).paginate_queryset(queryset, request, view=view)
 
     def get_page_size(self, request):
@@ -127,8 +306,134 @@ class CustomPagination(PageNumberPagination):
             page_size = self.max_page_size
         return page_size
 
+    def get_keyset_ordering(self, queryset):
+        """
+        return ordering of queryset as a list of (lookup, descending) ending with pk,
+        or None if the ordering contains expressions.
+        """
+        model = queryset.model
+        pk_name = model._meta.pk.name
+        ordering = []
+        for item in (queryset.query.order_by or model._meta.ordering or ()):
+            if isinstance(item, OrderBy) and isinstance(item.expression, F):
+                lookup, descending = item.expression.name, item.descending
+            elif isinstance(item, str) and item != '?':
+                descending = item.startswith('-')
+                lookup = item.lstrip('-+')
+            else:
+                return None
+            if lookup == 'pk':
+                lookup = pk_name
+            if LOOKUP_SEP not in lookup:
+                try:
+                    field = model._meta.get_field(lookup)
+                except FieldDoesNotExist:
+                    # an annotation, values are still available on objects
+                    field = None
+                if field is not None and field.is_relation:
+                    if not field.concrete or field.related_model._meta.ordering:
+                        return None
+                    lookup = field.attname
+            ordering.append((lookup, descending))
+            if lookup == pk_name:
+                break
+        if not any(lookup == pk_name for lookup, _ in ordering):
+            ordering.append((pk_name, False))
+        return ordering
+
+    @staticmethod
+    def _keyset_order_by(ordering, reverse=False):
+        order_by = []
+        for lookup, descending in ordering:
+            if descending != reverse:
+                order_by.append(F(lookup).desc(nulls_first=True))
+            else:
+                order_by.append(F(lookup).asc(nulls_last=True))
+        return order_by
+
+    @staticmethod
+    def _keyset_filter(ordering, values, reverse=False):
+        """ Q object selecting rows after ``values`` in ``ordering`` (before them if reverse) """
+        condition = None
+        equals = Q()
+        for (lookup, descending), value in zip(ordering, values):
+            if descending == reverse:
+                after = Q(**{lookup + '__gt': value}) | Q(**{lookup + '__isnull': True}) if value is not None \
+                    else None
+            else:
+                after = Q(**{lookup + '__lt': value}) if value is not None else Q(**{lookup + '__isnull': False})
+            if after is not None:
+                term = equals & after
+                condition = term if condition is None else condition | term
+            equals &= Q(**{lookup: value}) if value is not None else Q(**{lookup + '__isnull': True})
+        return condition
+
+    def encode_cursor(self, ordering, row, direction):
+        values = [_get_lookup_value(row, lookup) for lookup, _ in ordering]
+        data = {'o': [[lookup, descending] for lookup, descending in ordering], 'v': values, 'd': direction}
+        return signing.dumps(data, salt=self.CURSOR_SALT, serializer=_CursorSerializer, compress=True)
+
+    def decode_cursor(self, token, ordering):
+        try:
+            data = signing.loads(token, salt=self.CURSOR_SALT, serializer=_CursorSerializer)
+        except signing.BadSignature:
+            raise NotFound(self.invalid_cursor_message)
+        if data.get('o') != [[lookup, descending] for lookup, descending in ordering] or \
+                data.get('d') not in ('n', 'p') or len(data.get('v') or ()) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return data['v'], data['d'] == 'p'
+
+    def paginate_keyset(self, queryset, request, ordering):
+        self.request = request
+        page_size = self.get_page_size(request)
+        token = request.query_params.get(self.cursor_query_param)
+        reverse = False
+        if token:
+            values, reverse = self.decode_cursor(token, ordering)
+            condition = self._keyset_filter(ordering, values, reverse=reverse)
+            queryset = queryset.filter(condition) if condition is not None else queryset.none()
+        immediate, deferred = queryset.query.deferred_loading
+        if immediate and not deferred:
+            # cursor values are read from the rows, load local ordering columns with the sparse fieldset
+            queryset = queryset.only(*immediate, *(lookup for lookup, _ in ordering if LOOKUP_SEP not in lookup))
+        rows = list(queryset.order_by(*self._keyset_order_by(ordering, reverse=reverse))[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, bool(token)
+        self.next_cursor = self.encode_cursor(ordering, rows[-1], 'n') if rows and self.has_next else None
+        self.previous_cursor = self.encode_cursor(ordering, rows[0], 'p') if rows and self.has_previous else None
+        return rows
+
+    def _get_cursor_link(self, cursor):
+        if cursor is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
     def get_paginated_response(self, data):
         """ override pagination structure in list rest api """
+        if self.mode == self.MODE_KEYSET:
+            return Response({
+                'pagination': {
+                    'next_url': self._get_cursor_link(self.next_cursor),
+                    'previous_url': self._get_cursor_link(self.previous_cursor),
+                    'next_cursor': self.next_cursor,
+                    'previous_cursor': self.previous_cursor,
+                    'current_page': None,
+                    'next_page': None,
+                    'previous_page': None,
+                    'first_page': None,
+                    'last_page': None,
+                    'page_size': self.get_page_size(self.request),
+                    'total': None,
+                },
+                'results': data
+            })
+
         next_page = self.page.next_page_number() if \
             self.page.has_next() else None
         previous_page = self.page.previous_page_number() if \
@@ -149,6 +454,143 @@ class CustomPagination(PageNumberPagination):
         })
 
 
+class StreamingListMixin(object):
+    """
+    Stream the list api as a chunked json response instead of building the whole page in memory.
+
+    it's used for unbounded lists (views with ``max_page_size = 0``) when ``page_size=0`` or ``stream=1`` is
+    requested. rows are read with a server-side cursor (``queryset.iterator``) and serialized and rendered in
+    batches of ``stream_batch_size``, so memory usage doesn't depend on the number of rows.
+    response shape is ``{"results": [...], "pagination": {...}}``, ``total`` is known only at the end.
+    django 3.1 iterates streaming responses inside the event loop under asgi, so asgi requests are not streamed.
+    """
+    stream_batch_size = 500
+    stream_query_param = 'stream'
+
+    def should_stream(self, request):
+        if getattr(self, 'max_page_size', None) != 0 or isinstance(request._request, ASGIRequest):
+            return False
+        params = request.query_params
+        return params.get(self.stream_query_param) in ('1', 'true') or \
+            params.get(self.paginator.page_size_query_param if self.paginator else 'page_size') == '0'
+
+    def _render_batch(self, renderer, batch):
+        data = renderer.render(self.get_serializer(batch, many=True).data)
+        return data[1:-1]  # strip brackets of the rendered list
+
+    def stream_json(self, queryset):
+        renderer = JSONRenderer()
+        yield b'{"results":['
+        total = 0
+        batch = []
+        for obj in queryset.iterator(chunk_size=self.stream_batch_size):
+            batch.append(obj)
+            if len(batch) >= self.stream_batch_size:
+                yield (b',' if total else b'') + self._render_batch(renderer, batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            yield (b',' if total else b'') + self._render_batch(renderer, batch)
+            total += len(batch)
+        pagination = {
+            'next_url': None, 'previous_url': None, 'current_page': 1, 'next_page': None, 'previous_page': None,
+            'first_page': 1, 'last_page': 1, 'page_size': total, 'total': total,
+        }
+        yield b'],"pagination":' + renderer.render(pagination) + b'}'
+
+    def list(self, request, *args, **kwargs):
+        if not self.should_stream(request):
+            return super(StreamingListMixin, self).list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(self.stream_json(queryset), content_type='application/json')
+
+
+def _collect_sparse_fields(model, fields, prefix, only, select_related):
+    """
+    add model field paths needed by serializer ``fields`` to ``only`` and forward relations of nested
+    serializers to ``select_related``. return False if a field can't be mapped to model fields.
+    """
+    for field in fields.values():
+        if field.write_only:
+            continue
+        if field.source == '*':
+            return False
+        attrs = field.source.split('.')
+        current_model = model
+        path = prefix
+        for i, attr in enumerate(attrs):
+            try:
+                model_field = current_model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                return False
+            last = i == len(attrs) - 1
+            if model_field.many_to_many or model_field.one_to_many:
+                # loaded by its own query, it needs only the pk of this row
+                if not last:
+                    return False
+                break
+            if not model_field.concrete:
+                return False
+            name = path + attr
+            only.add(name)
+            if last and not (isinstance(field, serializers.BaseSerializer) and model_field.is_relation):
+                break
+            if not model_field.is_relation:
+                return False
+            select_related.add(name)
+            current_model = model_field.related_model
+            path = name + LOOKUP_SEP
+            if last and not _collect_sparse_fields(current_model, field.fields, path, only, select_related):
+                return False
+    return True
+
+
+def get_sparse_projection(model, serializer):
+    """
+    return (only, select_related) field paths of ``model`` needed to serialize ``serializer.fields``,
+    or None if some fields can't be mapped to model fields (i.e. properties and method fields).
+    pk and tenant columns are always included.
+    """
+    only = {model._meta.pk.name}
+    select_related = set()
+    tenant_id = getattr(model, 'tenant_id', None)
+    if tenant_id:
+        for field in model._meta.concrete_fields:
+            if tenant_id in (field.name, field.attname):
+                only.add(field.name)
+    if not _collect_sparse_fields(model, serializer.fields, '', only, select_related):
+        return None
+    return sorted(only), sorted(select_related)
+
+
+class SparseFieldsetMixin(object):
+    """
+    Load only the columns needed by the fields requested with ``fields``/``xfields``
+    (see DynamicFieldsSerializerMixin) in list and retrieve apis.
+
+    the queryset is narrowed with ``only()`` and nested serializers of forward relations are loaded with
+    ``select_related``. when a requested field isn't a model field (properties, method fields, ...) the queryset
+    is left as is, because loading deferred columns row by row is worse than loading all of them.
+    """
+    sparse_fieldset_params = ('fields', 'xfields')
+
+    def filter_queryset(self, queryset):
+        queryset = super(SparseFieldsetMixin, self).filter_queryset(queryset)
+        if self.request.method != 'GET' or \
+                not any(self.request.query_params.get(p) for p in self.sparse_fieldset_params):
+            return queryset
+        serializer = self.get_serializer()
+        if not isinstance(serializer, DynamicFieldsSerializerMixin):
+            return queryset
+        projection = get_sparse_projection(queryset.model, serializer)
+        if projection is None:
+            return queryset
+        only, select_related = projection
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        return queryset.only(*only)
+
+
 class DuplicateError(APIException):
     status_code = status.HTTP_409_CONFLICT
 
@@ -158,14 +600,36 @@ class ServiceUnavailable(APIException):
     default_detail = 'Service temporarily unavailable, try again later.'
 
 
+def _save_api_logs(logs):
+    from rest_framework_tracking.models import APIRequestLog
+    APIRequestLog.objects.bulk_create(logs)
+
+
+api_log_writer = BatchWriter(
+    'api-log-writer', _save_api_logs,
+    batch_size=getattr(settings, 'DRF_TRACKING_QUEUE_BATCH_SIZE', 200),
+    flush_interval=getattr(settings, 'DRF_TRACKING_QUEUE_FLUSH_INTERVAL', 2.0),
+    max_queue_size=getattr(settings, 'DRF_TRACKING_QUEUE_SIZE', 10000),
+    put_timeout=getattr(settings, 'DRF_TRACKING_QUEUE_PUT_TIMEOUT', 0.05),
+)
+
+
 class CustomLoggingMixin(LoggingMixin):
     '''
     Customized and enhanced LoggingMixin
+
+    with DRF_TRACKING_LOG_SINK = 'queue' logs are not saved in the request, they are queued and
+    bulk inserted by a background thread (see api_log_writer). when the queue is full, logs are dropped.
     '''
     CLEANED_SUBSTITUTE = '****'
     SKIPPED_SUBSTITUTE = '<<skipped>>'
     INVALID_SUBSTITUTE = '<<invalid>>'
+    TRUNCATED_SUBSTITUTE = '<<truncated>>'
+    DEFAULT_SENSITIVE_FIELDS = frozenset({'api', 'token', 'key', 'secret', 'password', 'signature'})
     logging_methods = settings.DRF_TRACKING_LOGGING_METHODS
+    logging_max_depth = getattr(settings, 'DRF_TRACKING_CLEAN_MAX_DEPTH', 8)
+    logging_max_items = getattr(settings, 'DRF_TRACKING_CLEAN_MAX_ITEMS', 5000)
+    logging_max_string_length = getattr(settings, 'DRF_TRACKING_CLEAN_MAX_STRING_LENGTH', 4096)
     sensitive_fields = {
         'current_password', 'new_password', 're_new_password'
     }
@@ -218,39 +682,100 @@ class CustomLoggingMixin(LoggingMixin):
             self.log['data'] = self.SKIPPED_SUBSTITUTE
         if skip_query_params:
             self.log['query_params'] = self.SKIPPED_SUBSTITUTE
+        if getattr(settings, 'DRF_TRACKING_LOG_SINK', 'sync') == 'queue':
+            from rest_framework_tracking.models import APIRequestLog
+            api_log_writer.put(APIRequestLog(**self.log))
+            return
         return super(CustomLoggingMixin, self).handle_log()
 
+    _redaction_rules = {}
+
+    @classmethod
+    def get_redaction_rules(cls):
+        """ lowercased (sensitive fields, skipped fields) of the view class, built once per class """
+        rules = CustomLoggingMixin._redaction_rules.get(cls)
+        if rules is None:
+            sensitive_fields = cls.DEFAULT_SENSITIVE_FIELDS | {field.lower() for field in cls.sensitive_fields or ()}
+            skipped_fields = frozenset(field.lower() for field in cls.skipped_fields or ())
+            rules = CustomLoggingMixin._redaction_rules[cls] = (sensitive_fields, skipped_fields)
+        return rules
+
+    def _clean_value(self, value):
+        """
+        parse lists and dicts serialized in short strings and truncate long strings.
+        only strings starting with a bracket are parsed, long ones are replaced as a whole
+        since a truncated part of them may still contain sensitive data.
+        """
+        if not isinstance(value, str):
+            return value
+        structured = value[:64].lstrip(' \t')[:1] in ('[', '{')
+        if len(value) > self.logging_max_string_length:
+            if structured:
+                return self.TRUNCATED_SUBSTITUTE
+            return value[:self.logging_max_string_length] + self.TRUNCATED_SUBSTITUTE
+        if structured:
+            try:
+                parsed = ast.literal_eval(value)
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                return value
+            if isinstance(parsed, (list, dict)):
+                return parsed
+        return value
+
     def _clean_data(self, data):
+        """
+        redact sensitive and skipped keys of request/response data.
+
+        the data is walked iteratively, containers deeper than ``logging_max_depth`` and values after the
+        first ``logging_max_items`` are replaced by ``TRUNCATED_SUBSTITUTE``.
+        """
         if isinstance(data, bytes):
             try:
                 data = data.decode()
             except UnicodeDecodeError:
                 data = self.INVALID_SUBSTITUTE
-
-        if isinstance(data, list):
-            return [self._clean_data(d) for d in data]
-        if isinstance(data, dict):
-            SENSITIVE_FIELDS = {'api', 'token', 'key', 'secret', 'password', 'signature'}
-            SKIPPED_FIELDS = self.skipped_fields or set()
-            data = dict(data)
-            if self.sensitive_fields:
-                SENSITIVE_FIELDS = SENSITIVE_FIELDS | {field.lower() for field in self.sensitive_fields}
-
-            for key in list(data.keys()):
-                if key.lower() in SKIPPED_FIELDS:
-                    data[key] = self.SKIPPED_SUBSTITUTE
-                    continue
-                if key.lower() in SENSITIVE_FIELDS:
-                    data[key] = self.CLEANED_SUBSTITUTE
+        if not isinstance(data, (list, dict)):
+            return data
+
+        sensitive_fields, skipped_fields = self.get_redaction_rules()
+        budget = self.logging_max_items
+        result = {} if isinstance(data, dict) else []
+        stack = [(result, data, 0)]
+        while stack:
+            target, source, depth = stack.pop()
+            if isinstance(source, dict):
+                items = dict(source).items()
+            else:
+                items = enumerate(source)
+            for key, value in items:
+                if budget <= 0:
+                    if isinstance(target, list):
+                        target.append(self.TRUNCATED_SUBSTITUTE)
+                        break
+                    target[key] = self.TRUNCATED_SUBSTITUTE
                     continue
-                value = data[key]
-                try:
-                    value = ast.literal_eval(value)
-                except (ValueError, SyntaxError):
-                    pass
-                if isinstance(value, list) or isinstance(value, dict):
-                    data[key] = self._clean_data(value)
-        return data
+                budget -= 1
+                if isinstance(target, dict):
+                    lower_key = str(key).lower()
+                    if lower_key in skipped_fields:
+                        target[key] = self.SKIPPED_SUBSTITUTE
+                        continue
+                    if lower_key in sensitive_fields:
+                        target[key] = self.CLEANED_SUBSTITUTE
+                        continue
+                value = self._clean_value(value)
+                if isinstance(value, (list, dict)):
+                    if depth + 1 >= self.logging_max_depth:
+                        value = self.TRUNCATED_SUBSTITUTE
+                    else:
+                        cleaned = {} if isinstance(value, dict) else []
+                        stack.append((cleaned, value, depth + 1))
+                        value = cleaned
+                if isinstance(target, list):
+                    target.append(value)
+                else:
+                    target[key] = value
+        return result
 
 
 class PermissionRequiredMixin(DjangoPermissionRequiredMixin):
@@ -288,26 +813,174 @@ class PermissionRequiredMixin(DjangoPermissionRequiredMixin):
                      ).dispatch(request, *args, **kwargs)
 
 
+class InternalViewMixin(object):
+    """
+    allow access only for staff users or requests with ``Authorization: Bearer <INTERNAL_API_TOKEN>``
+    (i.e: a metrics scraper). the client address is not trusted, behind a proxy every request comes from it.
+    """
+
+    @staticmethod
+    def has_internal_token(request):
+        token = getattr(settings, 'INTERNAL_API_TOKEN', None)
+        if not token:
+            return False
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        return auth.startswith('Bearer ') and hmac.compare_digest(auth[len('Bearer '):].encode(), token.encode())
+
+    def dispatch(self, request, *args, **kwargs):
+        user = request.user
+        is_staff = user.is_authenticated and (user.is_staff or user.is_superuser)
+        if not is_staff and not self.has_internal_token(request):
+            return JsonResponse({'error': 'Permission Denied'}, status=403)
+        return super(InternalViewMixin, self).dispatch(request, *args, **kwargs)
+
+
 class Base64ImageField(serializers.ImageField):
+    """
+    ImageField which also accepts an image as a data url (``data:image/png;base64,...``).
+
+    the data url is decoded in chunks straight into an uploaded file, in memory for small images and in a
+    temporary file for images bigger than FILE_UPLOAD_MAX_MEMORY_SIZE, so the image is never held decoded
+    in memory next to its base64 text. the size is checked before decoding (``max_image_size``, default
+    BASE64_IMAGE_MAX_SIZE) and the image type is taken from the first decoded bytes, not from the data url.
+    """
+    CHUNK_SIZE = 256 * 1024  # base64 chars decoded at once, a multiple of 4
+    DATA_URL_HEADER_MAX_LENGTH = 256
+    IMAGE_SIGNATURES = (
+        (b'\xff\xd8\xff', 'jpg', 'image/jpeg'),
+        (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+        (b'GIF87a', 'gif', 'image/gif'),
+        (b'GIF89a', 'gif', 'image/gif'),
+        (b'BM', 'bmp', 'image/bmp'),
+    )
+    default_error_messages = dict(
+        serializers.ImageField.default_error_messages,
+        image_too_large='Image is too large, the maximum size is {max_size} bytes.',
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.max_image_size = kwargs.pop('max_image_size', None) or \
+            getattr(settings, 'BASE64_IMAGE_MAX_SIZE', 10 * 1024 * 1024)
+        super(Base64ImageField, self).__init__(*args, **kwargs)
+
+    def _sniff_image_type(self, header):
+        for signature, ext, content_type in self.IMAGE_SIGNATURES:
+            if header.startswith(signature):
+                return ext, content_type
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return 'webp', 'image/webp'
+        self.fail('invalid_image')
+
+    def _iter_chunks(self, data, start=0):
+        """ yield base64 text of ``data`` (a string, a file or an iterable of strings) in chunks """
+        if isinstance(data, str):
+            for i in range(start, len(data), self.CHUNK_SIZE):
+                yield data[i:i + self.CHUNK_SIZE]
+        elif hasattr(data, 'read'):
+            while True:
+                chunk = data.read(self.CHUNK_SIZE)
+                if not chunk:
+                    return
+                # non ascii chars are rejected by the decoder
+                yield chunk.decode('ascii', 'replace') if isinstance(chunk, bytes) else chunk
+        else:
+            yield from data
+
+    def decode_data_url(self, data, start=0, encoded_length=None):
+        """ decode base64 text of ``data`` from ``start`` into an uploaded file """
+        if encoded_length is not None and encoded_length // 4 * 3 - 2 > self.max_image_size:
+            self.fail('image_too_large', max_size=self.max_image_size)
+        in_memory = encoded_length is not None and encoded_length // 4 * 3 <= settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+        output = BytesIO() if in_memory else TemporaryUploadedFile('upload', 'application/octet-stream', 0, None)
+        try:
+            size = 0
+            carry = ''
+            header = b''
+            image_type = None
+            for chunk in self._iter_chunks(data, start):
+                chunk = carry + ''.join(chunk.split())
+                usable = len(chunk) - len(chunk) % 4
+                carry = chunk[usable:]
+                try:
+                    decoded = base64.b64decode(chunk[:usable], validate=True)
+                except (binascii.Error, ValueError):
+                    self.fail('invalid_image')
+                size += len(decoded)
+                if size > self.max_image_size:
+                    self.fail('image_too_large', max_size=self.max_image_size)
+                if image_type is None:
+                    header += decoded[:16]
+                    if len(header) >= 16:
+                        image_type = self._sniff_image_type(header)
+                output.write(decoded)
+            if carry or not header:
+                self.fail('invalid_image')
+            image_type = image_type or self._sniff_image_type(header)
+        except Exception:
+            output.close()
+            raise
+
+        ext, content_type = image_type
+        name = uuid.uuid4().urn[9:] + '.' + ext
+        output.seek(0)
+        if in_memory:
+            return InMemoryUploadedFile(output, None, name, content_type, size, None)
+        output.name, output.content_type, output.size = name, content_type, size
+        return output
+
     def to_internal_value(self, data):
         if not isinstance(data, UploadedFile):
             if hasattr(data, 'read'):
-                data = data.read().decode()
-            if data.startswith('data:image'):
-                fmt, imgstr = data.split(';base64,')  # fmt ~= data:image/X,
-                ext = fmt.split('/')[-1]  # guess file extension
-                uid = uuid.uuid4()
-                data = ContentFile(base64.b64decode(imgstr), name=uid.urn[9:] + '.' + ext)
+                head = data.read(self.DATA_URL_HEADER_MAX_LENGTH)
+                head = head.decode() if isinstance(head, bytes) else head
+                if head.startswith('data:image') and ';base64,' in head:
+                    index = head.index(';base64,') + len(';base64,')
+                    data = self.decode_data_url(itertools.chain([head[index:]], self._iter_chunks(data)))
+                else:
+                    rest = data.read()
+                    data = head + (rest.decode() if isinstance(rest, bytes) else rest)
+            if isinstance(data, str) and data.startswith('data:image'):
+                index = data.find(';base64,', 0, self.DATA_URL_HEADER_MAX_LENGTH)
+                if index != -1:
+                    start = index + len(';base64,')
+                    data = self.decode_data_url(data, start, encoded_length=len(data) - start)
         return super(Base64ImageField, self).to_internal_value(data)
 
 
 class CustomFileBasedEmailBackend(EmailBackend):
+    """
+    ``EMAIL_BODY_TO_FILE_MODE`` is how message bodies are written to ``EMAIL_BODY_TO_FILE``: 'overwrite' keeps
+    the last body only, 'append' keeps all of them, 'rotate' appends and renames a file bigger than
+    ``EMAIL_BODY_TO_FILE_MAX_BYTES`` to ``<file>.1`` (keeping ``EMAIL_BODY_TO_FILE_BACKUPS`` old files).
+    """
+    body_file_lock = threading.Lock()
+
+    def write_body_to_file(self, path, body):
+        mode = getattr(settings, 'EMAIL_BODY_TO_FILE_MODE', 'overwrite')
+        if mode == 'overwrite':
+            with open(path, 'w') as f:
+                f.write(body)
+            return
+        with self.body_file_lock:
+            if mode == 'rotate' and os.path.exists(path) and \
+                    os.path.getsize(path) >= getattr(settings, 'EMAIL_BODY_TO_FILE_MAX_BYTES', 10 * 1024 * 1024):
+                backups = getattr(settings, 'EMAIL_BODY_TO_FILE_BACKUPS', 5)
+                for i in range(backups - 1, 0, -1):
+                    if os.path.exists('{}.{}'.format(path, i)):
+                        os.replace('{}.{}'.format(path, i), '{}.{}'.format(path, i + 1))
+                if backups:
+                    os.replace(path, path + '.1')
+                else:
+                    os.remove(path)
+            with open(path, 'a') as f:
+                f.write(body)
+                f.write('\n' + '-' * 79 + '\n')
+
     def write_message(self, message):
         res = super(CustomFileBasedEmailBackend, self).write_message(message)
         if getattr(settings, 'EMAIL_BODY_TO_FILE'):
             try:
-                with open(settings.EMAIL_BODY_TO_FILE, 'w') as f:
-                    f.write(str(message.body))
+                self.write_body_to_file(settings.EMAIL_BODY_TO_FILE, str(message.body))
             except Exception:
                 traceback.print_exc()
         if getattr(settings, 'EMAIL_BODY_TO_CONSOLE') is True:
@@ -345,6 +1018,11 @@ def send_sms(message, to, from_=None, fail_silently=False):
     return api.send_sms(body=message, from_phone=from_, to=to, fail_silently=fail_silently)
 
 
+def send_bulk_sms(message, to, from_=None, callback=None):
+    """ send ``message`` to many recipients in background, return a future of their results. see SmsDispatcher """
+    return sms_dispatcher.dispatch(message, to, from_=from_, callback=callback)
+
+
 def ex_reverse(viewname, **kwargs):
     if viewname.startswith('http://') or viewname.startswith('https://'):
         return viewname
@@ -372,22 +1050,164 @@ def ex_reverse(viewname, **kwargs):
 
 
 
+def _md5_file(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 64 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
 class IgnorableManifestFilesMixin(ManifestFilesMixin):
+    """
+    Manifest storage which doesn't hash files matching ``STATICFILES_MANIFEST_IGNORE_PATTERNS``.
+
+    in incremental mode (``STATICFILES_MANIFEST_INCREMENTAL``) the md5 of every source file and the files referenced
+    by every css file are kept in ``manifest_state_name``. the next collectstatic post processes only changed files
+    and the css files referencing them (recursively), other files keep their hashed names of the previous manifest.
+    source files are hashed in a process pool of ``STATICFILES_HASH_WORKERS`` processes.
+    """
     IGNORE_PATTERNS = (
         '^vue/',
     )
+    manifest_state_name = 'staticfiles.state.json'
+    # hashing less files in a process pool is slower than hashing them here
+    min_files_for_pool = 256
 
-    def post_process(self, paths, *args, **kwargs):
-        new_paths = OrderedDict()
+    def __init__(self, *args, **kwargs):
+        super(IgnorableManifestFilesMixin, self).__init__(*args, **kwargs)
         ignore_patterns = getattr(settings, 'STATICFILES_MANIFEST_IGNORE_PATTERNS', None)
         if ignore_patterns is None:
             ignore_patterns = self.IGNORE_PATTERNS
+        self._ignore_re = re.compile('|'.join('(?:{})'.format(p) for p in ignore_patterns)) \
+            if ignore_patterns else None
+        self.incremental = getattr(settings, 'STATICFILES_MANIFEST_INCREMENTAL', False)
+        self._source_hashes = {}
+        self._unchanged_files = {}
+        self._state = None
+
+    def hash_sources(self, paths):
+        """ return {name: md5 of the source file} """
+        local, remote = {}, []
+        for name, (storage, path) in paths.items():
+            try:
+                local[name] = storage.path(path)
+            except NotImplementedError:
+                remote.append(name)
+        hashes = {}
+        workers = getattr(settings, 'STATICFILES_HASH_WORKERS', None) or os.cpu_count() or 1
+        if workers > 1 and len(local) >= self.min_files_for_pool:
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                hashes.update(zip(local, executor.map(_md5_file, local.values(), chunksize=64)))
+        else:
+            hashes.update((name, _md5_file(path)) for name, path in local.items())
+        for name in remote:
+            storage, path = paths[name]
+            md5 = hashlib.md5()
+            with storage.open(path) as f:
+                for chunk in f.chunks():
+                    md5.update(chunk)
+            hashes[name] = md5.hexdigest()
+        return hashes
+
+    def file_hash(self, name, content=None):
+        # the original content of a file is hashed by hash_sources already, processed css isn't
+        source_hash = self._source_hashes.get(name)
+        if source_hash and content is not None and not isinstance(content, ContentFile):
+            return source_hash[:12]
+        return super(IgnorableManifestFilesMixin, self).file_hash(name, content)
+
+    def get_dependencies(self, name, storage, path):
+        """ names of the static files referenced by a css file """
+        with storage.open(path) as f:
+            content = f.read().decode('utf-8')
+        dependencies = set()
+        for extension, patterns in self._patterns.items():
+            if not matches_patterns(path, (extension,)):
+                continue
+            for pattern, template in patterns:
+                for match in pattern.finditer(content):
+                    url = match.group(2).split('#', 1)[0].split('?', 1)[0]
+                    if not url or re.match(r'^[a-z][a-z0-9+.-]*:|^//', url, re.IGNORECASE):
+                        continue
+                    if url.startswith(settings.STATIC_URL):
+                        target = url[len(settings.STATIC_URL):]
+                    elif url.startswith('/'):
+                        continue
+                    else:
+                        target = posixpath.join(posixpath.dirname(self.clean_name(name)), url)
+                    dependencies.add(posixpath.normpath(target))
+        return sorted(dependencies)
+
+    def load_state(self):
+        try:
+            with self.open(self.manifest_state_name) as f:
+                state = json.loads(f.read().decode())
+        except (FileNotFoundError, ValueError):
+            return {}
+        return state if state.get('version') == self.manifest_version else {}
+
+    def save_state(self, state):
+        if self.exists(self.manifest_state_name):
+            self.delete(self.manifest_state_name)
+        self._save(self.manifest_state_name, ContentFile(json.dumps(state).encode()))
+
+    def _stored_name(self, name, hashed_files):
+        # css files which are post processed again refer to unchanged files by their previous hashed names
+        hash_key = self.hash_key(self.clean_name(posixpath.normpath(name)))
+        if hash_key not in hashed_files and hash_key in self._unchanged_files:
+            return self._unchanged_files[hash_key]
+        return super(IgnorableManifestFilesMixin, self)._stored_name(name, hashed_files)
+
+    def save_manifest(self):
+        self.hashed_files = dict(self._unchanged_files, **self.hashed_files)
+        super(IgnorableManifestFilesMixin, self).save_manifest()
+        if self._state is not None:
+            self.save_state(self._state)
+
+    def post_process(self, paths, *args, **kwargs):
+        new_paths = OrderedDict()
         for k in list(paths.keys()):
-            matched_ignores = any([re.match(p, k) for p in ignore_patterns])
-            if not matched_ignores:
+            if self._ignore_re is None or not self._ignore_re.match(k):
                 new_paths[k] = paths[k]
-        res = super().post_process(new_paths, *args, **kwargs)
-        return res
+        self._source_hashes, self._unchanged_files, self._state = {}, {}, None
+        if not self.incremental or kwargs.get('dry_run'):
+            return super().post_process(new_paths, *args, **kwargs)
+        return self._post_process_incremental(new_paths, *args, **kwargs)
+
+    def _post_process_incremental(self, paths, *args, **kwargs):
+        sources = self.hash_sources(paths)
+        self._source_hashes = {self.clean_name(name): md5 for name, md5 in sources.items()}
+        state = self.load_state()
+        previous_sources, previous_dependencies = state.get('sources', {}), state.get('dependencies', {})
+        previous_files = self.load_manifest() if state else {}
+
+        unchanged = {}
+        for name in paths:
+            hashed_name = previous_files.get(self.hash_key(self.clean_name(name)))
+            if hashed_name and previous_sources.get(name) == sources[name] and self.exists(hashed_name):
+                unchanged[name] = hashed_name
+        dependencies = {}
+        for name, (storage, path) in paths.items():
+            if matches_patterns(path, self._patterns):
+                dependencies[name] = previous_dependencies[name] if name in unchanged and \
+                    name in previous_dependencies else self.get_dependencies(name, storage, path)
+        # a css file referencing a changed file gets a new content, so does a css file referencing it
+        changed = True
+        while changed:
+            changed = False
+            for name, names in dependencies.items():
+                if name in unchanged and any(n in paths and n not in unchanged for n in names):
+                    del unchanged[name]
+                    changed = True
+
+        self._unchanged_files = {self.hash_key(self.clean_name(name)): hashed_name
+                                 for name, hashed_name in unchanged.items()}
+        self._state = {'version': self.manifest_version, 'sources': sources, 'dependencies': dependencies}
+        for name, hashed_name in unchanged.items():
+            yield name, hashed_name, False
+        yield from super().post_process(
+            OrderedDict((name, paths[name]) for name in paths if name not in unchanged), *args, **kwargs)
 
 
 
@@ -396,12 +1216,15 @@ class OverwriteFileSystemStorage(FileSystemStorage):
 
     def get_available_name(self, name, max_length=None):
         """
-        Returns a filename that's free on the target storage system, and
-        available for new content to be written to.
+        Returns the name itself, an existing file is replaced by _save.
         """
-        # If the filename already exists, remove it as if it was a true file system
-        if self.exists(name):
-            os.remove(os.path.join(settings.MEDIA_ROOT, name))
+        return name
+
+    def _save(self, name, content):
+        # write to a temporary name and rename it over the target, readers never see a partial or missing file
+        directory, filename = os.path.split(name)
+        tmp_name = super()._save(os.path.join(directory, '.{}.{}.tmp'.format(filename, uuid.uuid4().hex)), content)
+        os.replace(self.path(tmp_name), self.path(name))
         return name
 
 
@@ -421,7 +1244,7 @@ def custom_rest_exception_handler(exc, context):
 
     if isinstance(exc, ProtectedError):
         data = {'detail': ' Not able to delete, there are links to this record and is protected.'}
-        traceback.print_exc()
+        error_report.report(exc)
         set_rollback()
         return Response(data, status=status.HTTP_412_PRECONDITION_FAILED)
 
@@ -432,7 +1255,7 @@ def custom_rest_exception_handler(exc, context):
         return Response(data, status=status.HTTP_409_CONFLICT)
 
     if response is None:
-        traceback.print_exc()
+        error_report.report(exc)
         return Response({'detail': 'unexpected server error'},
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR, exception=True)
 
@@ -455,8 +1278,12 @@ class DynamicFieldsSerializerMixin(object):
     fields=id,name
     or
     xfields=name1,name2
+
+    pruned top level fields are cached per serializer class and fields combination (see get_fields),
+    nested exclusions (i.e: xfields=user.email) are applied per instance.
     """
     extra_fields = []
+    _field_templates = LRUCache(maxsize=getattr(settings, 'DYNAMIC_FIELDS_CACHE_SIZE', 512))
 
     def __init__(self, *args, **kwargs):
         super(DynamicFieldsSerializerMixin, self).__init__(*args, **kwargs)
@@ -467,20 +1294,32 @@ class DynamicFieldsSerializerMixin(object):
         fields = params.get('fields')
         xfields = params.get('xfields')
         exfields = (params.get('exfields') or '').split(',')
-        if fields:
-            fields = fields.split(',')
-            allowed = set(fields)
-            existing = set(self.fields.keys())
-            for field_name in existing - allowed:
-                self.fields.pop(field_name)
-        if xfields:
-            xfields = xfields.split(',')
-            for field_name in xfields:
+        excluded = xfields.split(',') if xfields else []
+        excluded.extend(f for f in self.extra_fields if f not in exfields)
+        self._dynamic_fields_key = (
+            frozenset(fields.split(',')) if fields else None,
+            frozenset(f for f in excluded if '.' not in f),
+        )
+        for field_name in excluded:
+            if '.' in field_name:
                 self._exclude_field(field_name.split('.'))
 
-        for extra_field in self.extra_fields:
-            if extra_field not in exfields:
-                self._exclude_field(extra_field.split('.'))
+    def _build_field_template(self, key):
+        allowed, excluded = key
+        template = super(DynamicFieldsSerializerMixin, self).get_fields()
+        for field_name in list(template.keys()):
+            if (allowed is not None and field_name not in allowed) or field_name in excluded:
+                template.pop(field_name)
+        return template
+
+    def get_fields(self):
+        key = getattr(self, '_dynamic_fields_key', None)
+        if key is None:
+            return super(DynamicFieldsSerializerMixin, self).get_fields()
+        template = self._field_templates.get_or_set(
+            (self.__class__,) + key, lambda: self._build_field_template(key)
+        )
+        return copy.deepcopy(template)
 
     def _exclude_field(self, field_name, fields_container=None):
         if fields_container == None:
@@ -489,7 +1328,8 @@ class DynamicFieldsSerializerMixin(object):
         if len(field_name) == 1:
             return fields_container.pop(field_name[0], None)
         inner_fields = fields_container.get(field_name[0], None)
-        if not inner_fields:
+        inner_fields = getattr(inner_fields, 'child', inner_fields)
+        if not isinstance(inner_fields, serializers.Serializer):
             return
         return self._exclude_field(field_name[1:], inner_fields.fields)
 
@@ -533,6 +1373,9 @@ class ExtendedOrderingFilterBackend(OrderingFilterBackend):
 
     def get_ordering(self, request, queryset, view):
         fields = super(ExtendedOrderingFilterBackend, self).get_ordering(request, queryset, view)
+        if SEARCH_RANK in queryset.query.annotations and not request.query_params.get(self.ordering_param):
+            # keep full text search results ranked unless an ordering is requested
+            fields = ['-' + SEARCH_RANK] + list(fields or ())
         extra_fields = getattr(view, 'extra_ordering_fields', {}) or {}
         if not extra_fields:
             return fields
@@ -608,8 +1451,9 @@ class shopCustomerPermission(IsAuthenticated):
         if not current_shop:
             return False
 
-        # TODO: we need to cache this
-        return request.user.shop_customer_members.filter(shop=current_shop).exists()
+        if membership_cache.model is None:
+            return request.user.shop_customer_members.filter(shop=current_shop).exists()
+        return membership_cache.is_member(request.user.pk, current_shop.pk)
 
 
 class shopModelBackend(ModelBackend):
@@ -626,6 +1470,20 @@ class shopModelBackend(ModelBackend):
     shop_ADMIN_PERMISSIONS = {
         *('{}.{}_{}'.format(m[0], a, m[1]) for m, actions in PERMISSION_MODELS.items() for a in actions)
     }
+    permission_cache = PermissionCache(shop_ADMIN_PERMISSIONS)
+
+    def _load_shop_permissions(self, user_obj):
+        """ return (user permissions, group permissions) of a shop user """
+        if user_obj.is_shop_admin_user:
+            return self.shop_ADMIN_PERMISSIONS, self.shop_ADMIN_PERMISSIONS
+        result = []
+        for from_name in ('user', 'group'):
+            perms_objs = getattr(self, '_get_{}_permissions'.format(from_name))(user_obj)
+            perms_objs = perms_objs.values_list('content_type__app_label', 'codename').order_by()
+            perms = {'{}.{}'.format(ct, name) for ct, name in perms_objs}
+            result.append(perms & self.shop_ADMIN_PERMISSIONS)
+        return tuple(result)
+
     def _get_permissions(self, user_obj, obj, from_name):
         current_shop = get_current_tenant()
         if current_shop:
@@ -634,17 +1492,8 @@ class shopModelBackend(ModelBackend):
 
             perm_cache_name = '_{}_perm_cache'.format(from_name)
             if not hasattr(user_obj, perm_cache_name):
-                if user_obj.is_shop_admin_user:
-                    perms = self.shop_ADMIN_PERMISSIONS
-                else:
-                    perms_objs = getattr(self, '_get_{}_permissions'.format(from_name))(user_obj)
-                    perms_objs = perms_objs.values_list('content_type__app_label', 'codename').order_by()
-                    perms = set()
-                    for ct, name in perms_objs:
-                        perm_name = '{}.{}'.format(ct, name)
-                        if perm_name in self.shop_ADMIN_PERMISSIONS:
-                            perms.add(perm_name)
-                setattr(user_obj, perm_cache_name, perms)
+                user_obj._user_perm_cache, user_obj._group_perm_cache = self.permission_cache.get(
+                    user_obj.pk, current_shop.pk, lambda: self._load_shop_permissions(user_obj))
             return getattr(user_obj, perm_cache_name)
         else:
             return super()._get_permissions(user_obj, obj, from_name)
@@ -721,31 +1570,20 @@ class IsOwnerOrReadOnlyPermission(IsOwnerPermission):
 
 
 def resize_photo(origin_field, resized_field, scale=100):
+    """
+    make a thumbnail of ``origin_field`` whose shorter side is ``scale`` and save it to ``resized_field``.
+    use ``thumbnail_pipeline`` to make thumbnails out of the request.
+    """
     new_name, new_extension = os.path.splitext(origin_field.name)
     new_extension = new_extension.lower()
 
     new_filename = new_name + '_size{}'.format(scale) + new_extension
 
-    if new_extension in ['.jpg', '.jpeg']:
-        FTYPE = 'JPEG'
-    elif new_extension == '.gif':
-        FTYPE = 'GIF'
-    elif new_extension == '.png':
-        FTYPE = 'PNG'
-    else:
-        raise Exception('Not supported format "{}"'.format(new_extension))
-
-    image = Image.open(origin_field).copy()
-    new_size = (scale, scale)
-    x, y = image.size
-
-    if x > scale and y > scale:
-        if x > y:
-            ratio = max(y / scale, 1)
-            new_size = (int(max(x / ratio, 1)), scale)
-        elif x < y:
-            ratio = max(x / scale, 1)
-            new_size = (scale, int(max(y / ratio, 1)))
+    FTYPE = get_image_format(origin_field.name)
+
+    image = open_image(origin_field, scale)
+    new_size = get_thumbnail_size(image.size, scale)
+    if new_size:
         image.thumbnail(new_size, Image.ANTIALIAS)
 
     # Save resizednail to in-memory file as StringIO
@@ -26,6 +26,7 @@ SECRET_KEY = '<RACE_MEMBERSHIP_SECRET_KEY>'
 DEBUG = True
 
 ALLOWED_HOSTS = []
+INTERNAL_API_TOKEN = os.environ.get('INTERNAL_API_TOKEN')  # bearer token of /internal/ endpoints, staff users need none
 
 
 # Application definition
@@ -60,12 +61,14 @@ INSTALLED_APPS = [
     'anymail',
     'dynamic_preferences',
     'ckeditor',
-    'apps.administration',
+    'apps.administration.apps.AdministrationConfig',
     'apps.shop',
 ]
 
 MIDDLEWARE = [
+    'service_bond.helpers.middleware.RequestTimeLoggingMiddleware',
     'service_bond.helpers.middleware.SubpathURLRoutingMiddleware',
+    'service_bond.helpers.middleware.QueryProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -95,7 +98,7 @@ REST_FRAMEWORK = {
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
     'DEFAULT_PAGINATION_CLASS': 'service_bond.helpers.utils.CustomPagination',
     'DEFAULT_FILTER_BACKENDS': (
-                                'rest_framework.filters.SearchFilter',
+                                'service_bond.helpers.search.FullTextSearchFilter',
                                 'service_bond.helpers.utils.ExtendedOrderingFilterBackend'),
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.SessionAuthentication',
@@ -198,6 +201,7 @@ USE_L10N = True
 USE_TZ = True
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 50 * 1024 * 1024  # 50 MB
+BASE64_IMAGE_MAX_SIZE = 10 * 1024 * 1024  # max decoded size of images sent as base64 data urls
 
 PHONENUMBER_DB_FORMAT = 'RFC3966'
 
@@ -215,8 +219,10 @@ LOGIN_REDIRECT_URL = '/ui-panel'
 SITE_ID = 1
 
 
-DEFAULT_FILE_STORAGE = 'service_bond.helpers.utils.OverwriteFileSystemStorage'
-PUBLIC_FILE_STORAGE = 'service_bond.helpers.utils.OverwriteFileSystemStorage'
+# uploads are stored once per content, use service_bond.helpers.storage.ContentAddressedS3Storage on s3
+DEFAULT_FILE_STORAGE = 'service_bond.helpers.storage.ContentAddressedFileSystemStorage'
+PUBLIC_FILE_STORAGE = 'service_bond.helpers.storage.ContentAddressedFileSystemStorage'
+CONTENT_ADDRESSED_STORAGE_PREFIX = 'cas'  # content addressed files are stored as <prefix>/ab/cd/<sha256><ext>
 
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
@@ -270,6 +276,9 @@ SUBPATH_URLCONFS = {
     # None: 'service_bond.urls',
     'shop': 'service_bond.urls_shop',
 }
+TENANT_REGISTRY_SIZE = 1024  # max number of shops (and unknown shop ids) kept in the tenant registry
+TENANT_REGISTRY_TTL = 300  # seconds
+TENANT_REGISTRY_NEGATIVE_TTL = 30  # seconds to remember that a shop id doesn't exist
 
 
 
@@ -280,6 +289,56 @@ DRF_TRACKING_SKIP_RESPONSE_DATA = {'get': True, 'option': True, 'head': True}
 DRF_TRACKING_SKIP_REQUEST_DATA = False
 DRF_TRACKING_SKIP_REQUEST_QUERY_PARAMS = False
 DRF_TRACKING_SKIP_ERRORS_DATA = False
+DRF_TRACKING_LOG_SINK = 'sync'  # 'sync': save every log in the request, 'queue': bulk insert in background (droppable)
+DRF_TRACKING_QUEUE_SIZE = 10000  # logs waiting to be saved, new logs are dropped when it's full
+DRF_TRACKING_QUEUE_PUT_TIMEOUT = 0.05  # seconds a request waits for room in a full queue before dropping its log
+DRF_TRACKING_QUEUE_BATCH_SIZE = 200
+DRF_TRACKING_QUEUE_FLUSH_INTERVAL = 2.0  # seconds
+DRF_TRACKING_CLEAN_MAX_DEPTH = 8  # deeper nested data is replaced by a truncation marker in logs
+DRF_TRACKING_CLEAN_MAX_ITEMS = 5000  # values logged per request data/response, the rest is truncated
+DRF_TRACKING_CLEAN_MAX_STRING_LENGTH = 4096  # longer strings are truncated and never parsed
+# fields kept in the search index of models (used by FullTextSearchFilter), run "manage.py rebuild_search_index"
+# after changing them
+SEARCH_INDEXES = {
+    'administration.Shop': ['name', 'title', 'email', 'phone_number', 'street_address', 'city', 'state', 'zipcode'],
+    'administration.Customer': ['first_name', 'last_name', 'phone_number', 'street_address', 'city', 'state',
+                                'zipcode'],
+}
+SHOP_MEMBERSHIP_MODEL = None  # 'app_label.Model' of shop memberships (user and shop foreign keys), enables caching
+MEMBERSHIP_CACHE_ALIAS = 'default'  # shared cache of membership checks
+MEMBERSHIP_CACHE_SIZE = 4096  # (user, shop) answers kept in memory of every process
+MEMBERSHIP_CACHE_TTL = 300  # seconds in the shared cache
+MEMBERSHIP_CACHE_LOCAL_TTL = 30  # seconds in process memory, max time other processes may miss a change
+MEMBERSHIP_CACHE_NEGATIVE_TTL = 30  # seconds to remember that a user is not a member
+PERMISSION_CACHE_ALIAS = 'default'  # shared cache (i.e. redis, memcached) of shop permissions, not used if local memory
+PERMISSION_CACHE_SIZE = 4096  # (user, shop) permission sets kept in memory of every process
+PERMISSION_CACHE_TTL = 3600  # seconds, entries are replaced by a version bump when permissions change
+THUMBNAIL_SIZES = {'small': 100, 'medium': 400}  # shorter side of thumbnails in pixels
+THUMBNAIL_FIELDS = {'administration.User': ['avatar']}  # image fields which get thumbnails on save
+THUMBNAIL_WORKERS = 2  # processes making thumbnails, 0 makes them in the saving thread
+THUMBNAIL_IO_WORKERS = 4  # threads reading originals and saving thumbnails, per process
+SMS_DISPATCH_TRANSPORT = 'service_bond.helpers.sms.TwilioTransport'  # FakeTransport keeps messages in memory
+SMS_DISPATCH_WORKERS = 16  # threads sending messages of a bulk sms, per process
+SMS_DISPATCH_RATE = 50  # messages per second per sms account, per process
+SMS_DISPATCH_RETRIES = 2  # retries of a message after a rate limit or server error
+EMAIL_BULK_CHUNK_SIZE = 500  # messages per call of the email backend in a bulk send, keep it under provider limits
+EMAIL_BODY_TO_FILE_MODE = 'overwrite'  # overwrite, append or rotate, see CustomFileBasedEmailBackend
+EMAIL_BODY_TO_FILE_MAX_BYTES = 10 * 1024 * 1024  # size of EMAIL_BODY_TO_FILE which is rotated in rotate mode
+EMAIL_BODY_TO_FILE_BACKUPS = 5  # rotated files kept
+ERROR_REPORT_SIZE = 200  # error fingerprints kept for /internal/errors
+ERROR_REPORT_FIRST_N = 5  # tracebacks printed for the first errors of a fingerprint
+ERROR_REPORT_SAMPLE_EVERY = 100  # after that, the traceback of every n-th error is printed
+ERROR_REPORT_FRAMES = 3  # innermost frames which make the fingerprint of an error
+STATICFILES_MANIFEST_INCREMENTAL = True  # collectstatic post processes only changed static files and their dependents
+STATICFILES_HASH_WORKERS = None  # processes hashing static files, None is the number of cpus
+DYNAMIC_FIELDS_CACHE_SIZE = 512  # pruned serializer fields kept per serializer class and fields/xfields combination
+
+
+# django-reversion settings
+REVISION_CAPTURE_MODE = 'sync'  # 'sync', 'after_response' or 'background', see CustomRevisionMiddleware
+REVISION_WRITER_BATCH_SIZE = 100  # revisions written together in 'background' mode
+REVISION_WRITER_FLUSH_INTERVAL = 1.0  # seconds
+REVISION_WRITER_QUEUE_SIZE = 10000  # requests block when this many revisions are waiting
 
 
 # project specific settings
@@ -290,3 +349,11 @@ RECOVERY_PASSWORD_SALT = 'recovery-password'
 RECOVERY_PASSWORD_AGE = 3600  # 1 hour
 PAGINATION_DEFAULT_PAGINATION = 15
 PAGINATION_MAX_SIZE = 200
+BUILD_ID = os.environ.get('BUILD_ID')  # exposed in X-Build-Id response header
+QUERY_PROFILER_SAMPLE_RATE = 0.05  # fraction of requests profiled by QueryProfilerMiddleware
+QUERY_PROFILER_N1_THRESHOLD = 5  # same query repeated this many times in one request is reported as N+1
+QUERY_PROFILER_REPORT_SIZE = 20  # worst repeated queries kept per view
+METRICS_ENABLED = True  # record request latency histograms, exposed on /internal/metrics
+METRICS_DIR = os.environ.get('METRICS_DIR')  # shared by all workers of a host, defaults to <tmp>/service_bond_metrics
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+BUILD_METADATA_CHECK_INTERVAL = 5  # seconds between checks for changes of ui package.json and static manifest
@@ -19,7 +19,7 @@ from django.views.static import serve
 from django.urls import path, include, re_path
 from rest_framework_jwt.views import obtain_jwt_token, refresh_jwt_token, verify_jwt_token
 
-from apps.administration.views import UiPanelView
+from apps.administration.views import UiPanelView, QueryReportView, MetricsView, ErrorReportView
 
 VERSION_PARAM = settings.REST_FRAMEWORK.get('VERSION_PARAM', 'version')
 DEFAULT_VERSION = settings.REST_FRAMEWORK.get('DEFAULT_VERSION', 'v1')
@@ -36,6 +36,9 @@ urlpatterns = [
     re_path(r'^token/auth/', obtain_jwt_token),
     re_path(r'^token/refresh/', refresh_jwt_token),
     re_path(r'^token/verify/', verify_jwt_token),
+    re_path(r'^internal/queries$', QueryReportView.as_view(), name='internal-queries'),
+    re_path(r'^internal/metrics$', MetricsView.as_view(), name='internal-metrics'),
+    re_path(r'^internal/errors$', ErrorReportView.as_view(), name='internal-errors'),
 ]
 
 if settings.DEBUG: